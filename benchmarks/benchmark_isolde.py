@@ -0,0 +1,289 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Benchmarks of the ISOLDE protocol paths that scale with the number of
+files saved during a session and with the size of the maps: writing the
+ChimeraX scripts, creating the outputs, the summary and methods, and the
+viewer. Every case is run on a new protocol whose extra directory is
+filled with synthetic maps and models, and ChimeraX is replaced by a
+stand-in executable that exits immediately.
+
+    python benchmarks/benchmark_isolde.py --files 10 100 1000 \\
+        --map-sizes 64 128 256 --save results.json
+
+Timings saved by a previous run can be given with --compare, the script
+then exits with an error if any case is slower than the tolerance.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# The plugin is imported from this checkout, wherever the script is run
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+HOSTS_CONF = """[localhost]
+PARALLEL_COMMAND = mpirun -np %_(JOB_NODES)d %_(COMMAND)s
+NAME = SCIPION_HOST
+ADDRESS = localhost
+CONNECTION =
+"""
+
+PDB_ATOM = ("ATOM  %5d  CA  ALA %s%4d    %8.3f%8.3f%8.3f  1.00 20.00"
+            "           C\n")
+CIF_HEADER = """data_synthetic
+loop_
+_atom_site.group_PDB
+_atom_site.id
+_atom_site.type_symbol
+_atom_site.label_atom_id
+_atom_site.label_comp_id
+_atom_site.label_asym_id
+_atom_site.label_seq_id
+_atom_site.Cartn_x
+_atom_site.Cartn_y
+_atom_site.Cartn_z
+_atom_site.occupancy
+_atom_site.B_iso_or_equiv
+"""
+CIF_ATOM = "ATOM %d C CA ALA %s %d %.3f %.3f %.3f 1.00 20.00\n"
+
+
+def setupEnvironment(workDir):
+    """ Isolated Scipion configuration and stand-in ChimeraX. Must be
+    called before importing pyworkflow or the plugin.
+    """
+    hostsFile = os.path.join(workDir, 'hosts.conf')
+    with open(hostsFile, 'w') as f:
+        f.write(HOSTS_CONF)
+    os.environ['SCIPION_HOSTS'] = hostsFile
+    os.environ['SCIPION_CONFIG'] = os.path.join(workDir, 'scipion.conf')
+    os.environ['SCIPION_USER_DATA'] = os.path.join(workDir, 'data')
+    os.environ['ISOLDE_CACHE'] = os.path.join(workDir, 'cache')
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))
+
+    chimeraHome = os.path.join(workDir, 'chimerax')
+    os.makedirs(os.path.join(chimeraHome, 'bin'))
+    program = os.path.join(chimeraHome, 'bin', 'ChimeraX')
+    with open(program, 'w') as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(program, os.stat(program).st_mode | stat.S_IEXEC)
+    os.environ['CHIMERA_HOME'] = chimeraHome
+
+
+def writeMap(fileName, size):
+    import mrcfile
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(np.random.random((size, size, size))
+                     .astype(np.float32))
+        mrc.voxel_size = 1.0
+        mrc.header.origin = (10.0, 20.0, 30.0)
+
+
+def writeModel(fileName, atoms):
+    coords = np.random.random((atoms, 3)) * 100
+    with open(fileName, 'w') as f:
+        if fileName.endswith('.cif'):
+            f.write(CIF_HEADER)
+            for i, (x, y, z) in enumerate(coords):
+                f.write(CIF_ATOM % (i + 1, 'A', i // 10 + 1, x, y, z))
+        else:
+            for i, (x, y, z) in enumerate(coords):
+                f.write(PDB_ATOM % ((i + 1) % 100000, 'A',
+                                    (i // 10 + 1) % 10000, x, y, z))
+            f.write("END\n")
+
+
+def writeTemplates(templatesDir, mapSize, atoms):
+    """ One map, mmCIF and PDB file of the requested sizes. """
+    os.makedirs(templatesDir, exist_ok=True)
+    templates = {ext: os.path.join(templatesDir, 'template_%d.%s'
+                                   % (mapSize, ext))
+                 for ext in ('mrc', 'cif', 'pdb')}
+    if not os.path.exists(templates['mrc']):
+        writeMap(templates['mrc'], mapSize)
+    for ext in ('cif', 'pdb'):
+        if not os.path.exists(templates[ext]):
+            writeModel(templates[ext], atoms)
+    return templates
+
+
+def linkFile(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def populateExtra(extraDir, numberOfFiles, templates, protId):
+    """ Files named as scipionwrite saves them: one map every ten files,
+    the rest split between mmCIF and PDB models.
+    """
+    for i in range(numberOfFiles):
+        if i % 10 == 0:
+            fileName = 'Map__%06d_%06d.mrc' % (protId, i)
+            template = templates['mrc']
+        elif i % 2:
+            fileName = 'Atom_struct__%06d_%06d.cif' % (protId, i)
+            template = templates['cif']
+        else:
+            fileName = 'Atom_struct__%06d_%06d.pdb' % (protId, i)
+            template = templates['pdb']
+        linkFile(template, os.path.join(extraDir, fileName))
+
+
+def timeCall(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def runCase(project, templates, numberOfFiles, headless):
+    """ Time every benchmarked path on a new protocol. """
+    from pwem.objects import AtomStruct, Volume
+    from isolde.constants import MODE_HEADLESS, VIEW_ALL
+    from isolde.protocols import ProtIsolde
+    from isolde.viewers.viewer import IsoldeViewer
+
+    protocol = project.newProtocol(ProtIsolde)
+    volume = Volume()
+    volume.setFileName(templates['mrc'])
+    volume.setSamplingRate(1.0)
+    protocol.inputVolume.set(volume)
+    protocol.pdbFileToBeRefined.set(AtomStruct(filename=templates['cif']))
+    if headless:
+        protocol.runMode.set(MODE_HEADLESS)
+    project.saveProtocol(protocol)
+    os.makedirs(protocol._getExtraPath(), exist_ok=True)
+    os.makedirs(protocol._getTmpPath(), exist_ok=True)
+    populateExtra(protocol._getExtraPath(), numberOfFiles, templates,
+                  protocol.getObjId())
+    with open(protocol._getExtraPath('chimera.ini'), 'w') as f:
+        f.write("[chimerax]\nenablebundle = True\n")
+
+    viewer = IsoldeViewer(project=project, protocol=protocol)
+    viewer.setProtocol(protocol)
+    viewer.selection.set(VIEW_ALL)
+    timings = {}
+    timings['writeChimeraScript'] = timeCall(protocol.writeChimeraScript)
+    timings['visualize (new files)'] = timeCall(viewer._visualizeOutputs)
+    timings['createOutputStep'] = timeCall(protocol.createOutputStep)
+    timings['summary and methods'] = timeCall(
+        lambda: (protocol._summary(), protocol._methods()))
+    timings['visualize'] = timeCall(viewer._visualizeOutputs)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help="Number of saved files in the extra directory")
+    parser.add_argument('--map-sizes', type=int, nargs='+',
+                        default=[64, 128, 256],
+                        help="Box size, in voxels, of the saved maps")
+    parser.add_argument('--atoms', type=int, default=5000,
+                        help="Atoms of every saved model")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs of every case, the best one is kept")
+    parser.add_argument('--headless', action='store_true',
+                        help="Write the headless script instead of the "
+                             "interactive one")
+    parser.add_argument('--save', help="Save the timings in a JSON file")
+    parser.add_argument('--compare',
+                        help="JSON file with timings of a previous run")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="Allowed slowdown factor with --compare")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the working directory")
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='isolde_benchmark_')
+    setupEnvironment(workDir)
+    import pwem
+    import pyworkflow
+    pyworkflow.Config.setDomain(pwem)
+    pwem.Domain.registerPlugin('isolde')
+    from pyworkflow.project import Manager
+
+    results = {}
+    cwd = os.getcwd()
+    try:
+        project = Manager().createProject('isoldeBenchmark')
+        os.chdir(project.path)
+        for mapSize in args.map_sizes:
+            templates = writeTemplates(os.path.join(workDir, 'templates'),
+                                       mapSize, args.atoms)
+            for numberOfFiles in args.files:
+                best = {}
+                for _ in range(args.repeat):
+                    timings = runCase(project, templates, numberOfFiles,
+                                      args.headless)
+                    for name, seconds in timings.items():
+                        best[name] = min(best.get(name, seconds), seconds)
+                for name, seconds in best.items():
+                    key = '%s/%d files/%d voxels' % (name, numberOfFiles,
+                                                     mapSize)
+                    results[key] = seconds
+                    print("%-24s %6d files %4d^3 map %10.4f s"
+                          % (name, numberOfFiles, mapSize, seconds))
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = ["%s: %0.4f s, was %0.4f s" % (key, seconds, baseline[key])
+                  for key, seconds in results.items()
+                  if key in baseline
+                  and seconds > baseline[key] * args.tolerance]
+        if slower:
+            print("Slower than %s:\n%s" % (args.compare, "\n".join(slower)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
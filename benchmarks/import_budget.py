@@ -0,0 +1,114 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Import time budget of the plugin. Scipion imports every plugin, with its
+protocols and viewers, to build its menus and to load projects, so the
+plugin must not load more than pwem already does. The modules that are
+only needed to run ChimeraX must not be imported at all.
+
+    python benchmarks/import_budget.py --budget 50
+"""
+
+import argparse
+import json
+import subprocess
+import shutil
+import sys
+import tempfile
+
+from benchmark_isolde import setupEnvironment
+
+# Modules every Scipion plugin pays for, loaded before timing the plugin
+BASELINE = ['pwem', 'pwem.protocols', 'pwem.objects',
+            'pyworkflow.protocol.params', 'pyworkflow.viewer']
+
+PLUGIN = ['isolde', 'isolde.protocols', 'isolde.viewers']
+
+DEFERRED = ['chimera', 'pwem.viewers.viewer_chimera', 'pwem.convert.headers',
+            'tkinter']
+
+MEASURE = """
+import importlib, json, sys, time
+for name in %r:
+    importlib.import_module(name)
+loaded = set(sys.modules)
+start = time.perf_counter()
+for name in %r:
+    importlib.import_module(name)
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'modules': sorted(set(sys.modules) - loaded)}))
+"""
+
+
+def measure():
+    """ Import time of the plugin and the modules it loads, in a new
+    interpreter.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', MEASURE % (BASELINE, PLUGIN)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=50,
+                        help="Maximum import time of the plugin (ms)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Interpreters to start, the fastest is kept")
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='isolde_imports_')
+    try:
+        setupEnvironment(workDir)
+        results = [measure() for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    best = min(results, key=lambda result: result['seconds'])
+    milliseconds = best['seconds'] * 1000
+    loaded = [name for name in best['modules']
+              if name.split('.')[0] not in PLUGIN]
+    print("Plugin import: %0.1f ms (budget %0.1f ms)"
+          % (milliseconds, args.budget))
+    print("Modules loaded besides the plugin: %s"
+          % (", ".join(loaded) or "none"))
+
+    errors = ["%s is imported" % name for name in best['modules']
+              if any(name == deferred or name.startswith(deferred + '.')
+                     for deferred in DEFERRED)]
+    if milliseconds > args.budget:
+        errors.append("import time is over budget")
+    if errors:
+        print("\n".join(errors))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,24 +24,59 @@
 # *
 # **************************************************************************
 
+import os
+
 import pwem
 
-from chimera import Plugin as chimera_plugin
+from .constants import (ISOLDE_CACHE, ISOLDE_CACHE_SIZE, ISOLDE_MIN_VERSION,
+                        INSTALL_SCRIPT)
 
 _logo = "icon.jpg"
 _references = ['CROLL2018']
 
 class Plugin(pwem.Plugin):
 
+    @classmethod
+    def _defineVariables(cls):
+        # EM_ROOT is often read-only on shared installations
+        cacheHome = os.environ.get('XDG_CACHE_HOME',
+                                   os.path.join(os.path.expanduser('~'),
+                                                '.cache'))
+        cls._defineVar(ISOLDE_CACHE,
+                       os.path.join(cacheHome, 'scipion-isolde'))
+        cls._defineVar(ISOLDE_CACHE_SIZE, 2048)
+
+    @classmethod
+    def getPrepCache(cls):
+        """ Cache of prepared (hydrogenated) input models shared by
+        all the runs.
+        """
+        from .cache import PrepCache
+        return PrepCache(cls.getVar(ISOLDE_CACHE),
+                         float(cls.getVar(ISOLDE_CACHE_SIZE)) * 1024 ** 2)
+
+    @classmethod
+    def getChimeraXProbe(cls):
+        """ ChimeraX and ISOLDE versions, probed again only when the
+        ChimeraX binary changes.
+        """
+        from .probe import probeChimeraX
+        return probeChimeraX(cls.getVar(ISOLDE_CACHE))
+
     @classmethod
     def defineBinaries(cls, env):
         """ Install ISOLDE with Chimerax toolshed command """
         from scipion.install.funcs import \
             VOID_TGZ  # Local import to avoid having scipion-app installed when building the package.
+        from chimera import Plugin as chimera_plugin
+        from .utils import getScript
 
         pathToChimera = chimera_plugin.getProgram()
-        installPluginsCommand = [("%s --nogui --exit " 
-                                  "--cmd 'toolshed install isolde; exit'" % pathToChimera, [])]
+        # No target, so the version is checked on every install; the
+        # toolshed is only queried if ISOLDE is missing or too old
+        installPluginsCommand = [("%s --nogui --exit --script '%s %s'"
+                                  % (pathToChimera, getScript(INSTALL_SCRIPT),
+                                     ISOLDE_MIN_VERSION), [])]
         env.addPackage('isolde', version='1.0',
                        tar=VOID_TGZ,
                        default=True,
@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Persistent cache of prepared input models, so that the slow preparation
+of a structure (adding hydrogens) is done once for a given input file and
+set of flags, no matter how many times the protocol is launched.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+BLOCK_SIZE = 1024 * 1024
+# Entries are named by a sha256 key; other files, e.g. the ChimeraX probe
+# state, may share the directory and are never evicted
+ENTRY_NAME = re.compile(r'^[0-9a-f]{64}\.\w+$')
+
+
+def fileKey(fileName, **flags):
+    """ Key of a file given its contents and the flags that change how it
+    is prepared.
+    """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            sha.update(block)
+    for flag in sorted(flags):
+        sha.update(("%s=%s;" % (flag, flags[flag])).encode())
+    return sha.hexdigest()
+
+
+class PrepCache:
+    """ Directory of files named by key. The modification time of an entry
+    is refreshed every time it is used, so the least recently used entries
+    are evicted first when the cache grows over maxSize bytes.
+    """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+
+    def _entry(self, key, extension):
+        return os.path.join(self.path, key + extension)
+
+    def get(self, key, extension='.cif'):
+        """ Return the cached file for key, or None. """
+        fileName = self._entry(key, extension)
+        if not os.path.exists(fileName):
+            return None
+        try:
+            os.utime(fileName)
+        except OSError:
+            pass  # read-only cache, the entry is still usable
+        return fileName
+
+    def put(self, key, fileName, extension='.cif'):
+        """ Copy fileName into the cache. The copy is written to a temporary
+        file first so concurrent runs never see a partial entry.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmpName = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(fileName, tmpName)
+        os.replace(tmpName, self._entry(key, extension))
+        self.evict()
+        return self._entry(key, extension)
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits in
+        maxSize. Only files named by a key count as entries.
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and ENTRY_NAME.match(entry.name):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fileName in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(fileName)
+            except FileNotFoundError:
+                pass  # removed by a concurrent run
+            total -= size
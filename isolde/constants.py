@@ -0,0 +1,104 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+# Plugin variables
+ISOLDE_CACHE = 'ISOLDE_CACHE'
+ISOLDE_CACHE_SIZE = 'ISOLDE_CACHE_SIZE'  # MB
+
+# Protocol run modes
+MODE_INTERACTIVE = 0
+MODE_HEADLESS = 1
+
+# Stop criteria for headless simulations
+STOP_FIXED_STEPS = 0
+STOP_CONVERGENCE = 1
+
+# How a single model is divided for headless simulation
+SPLIT_NONE = 0
+SPLIT_CHAINS = 1
+SPLIT_SPATIAL = 2
+
+# OpenMM platform of the simulations, PLATFORM_DEFAULT lets ISOLDE choose
+PLATFORM_DEFAULT = 0
+PLATFORM_CPU = 1
+PLATFORM_OPENCL = 2
+PLATFORM_CUDA = 3
+OPENMM_PLATFORMS = [None, 'CPU', 'OpenCL', 'CUDA']
+
+# Files written in the protocol extra directory
+CHIMERA_SCRIPT = 'chimera_script.cxc'
+# Output of the ChimeraX sessions opened by the viewer, in the tmp dir
+VIEWER_LOG = 'chimera_viewer.log'
+HEADLESS_SCRIPT = 'chimera_script.py'
+HEADLESS_MODEL = 'isolde_refined.cif'
+MANIFEST_FILE = 'outputs.jsonl'
+PENDING_FILE = 'outputs_pending.json'
+PREPARED_DIR = 'prepared'
+REGIONS_DIR = 'regions'
+STAGES_DIR = 'stages'
+SWEEP_DIR = 'sweep'
+TRAJECTORY_DIR = 'trajectory'
+TRAJECTORY_TOPOLOGY = 'topology.cif'
+TRAJECTORY_COORDS = 'coords.f32'
+TRAJECTORY_INFO = 'trajectory.json'
+REGIONS_FILE = 'regions.json'
+REGION_CROPS = 'region_crops.json'
+METRICS_FILE = 'metrics.json'
+CHIMERA_METRICS = 'chimera_metrics.json'
+CHIMERA_PID = 'chimerax_%d.pid'  # worker slot
+FIT_JOBS = 'fit_jobs.json'
+FIT_TABLE = 'fit_metrics.csv'
+FIT_SUMMARY = 'fit_summary.json'
+RESTRAINTS_FILE = 'reference_restraints.json'
+SWEEP_FILE = 'sweep.json'
+SWEEP_TABLE = 'sweep_results.csv'
+
+# State of the ChimeraX installation, kept in the ISOLDE cache directory
+PROBE_FILE = 'chimerax_probe.json'
+
+# ChimeraX scripts shipped in isolde/scripts
+REGIONS_SCRIPT = 'isolde_regions.py'
+PREPARE_SCRIPT = 'isolde_prepare.py'
+CROP_SCRIPT = 'isolde_crop.py'
+CHECKPOINT_SCRIPT = 'isolde_checkpoint.py'
+RESTORE_SCRIPT = 'isolde_restore.py'
+PROBE_SCRIPT = 'isolde_probe.py'
+INSTALL_SCRIPT = 'isolde_install.py'
+VALIDATE_SCRIPT = 'isolde_validate.py'
+RESTRAINTS_SCRIPT = 'isolde_restraints.py'
+FILTER_SCRIPT = 'isolde_filter.py'
+PLATFORM_SCRIPT = 'isolde_platform.py'
+
+# Oldest ISOLDE release the protocol works with
+ISOLDE_MIN_VERSION = '1.0'
+
+# Saved outputs opened by the viewer
+VIEW_NEWEST = 0
+VIEW_ALL = 1
+VIEW_CHOSEN = 2
+
+# ISOLDE advances this many timesteps per graphics frame unless told otherwise
+DEFAULT_STEPS_PER_FRAME = 50
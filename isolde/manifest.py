@@ -0,0 +1,182 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Index of the models and maps saved in a protocol extra directory. Every
+save appends one JSON line with the file name, its type and, for maps,
+sampling and origin, so the protocol and the viewer read a single small
+file instead of listing the directory and parsing every map header.
+"""
+
+import json
+import os
+from collections import OrderedDict
+
+from .constants import MANIFEST_FILE, PENDING_FILE
+from .volumes import getMapInfo
+
+ATOMSTRUCT = 'atomstruct'
+VOLUME = 'volume'
+
+
+def getOutputKeyword(filename):
+    """ Name of the protocol output registered for a saved file. """
+    if filename.endswith(".mrc"):
+        return filename.split(".mrc")[0]
+    if filename.endswith(".cif"):
+        return filename.split(".cif")[0].replace(".", "_")
+    return filename.split(".pdb")[0].replace(".", "_")
+
+
+def manifestEntry(filename, fileType, **info):
+    """ Manifest line, as a dict, for a file saved in the directory. """
+    filename = os.path.basename(filename)
+    entry = {'filename': filename,
+             'type': fileType,
+             'keyword': getOutputKeyword(filename)}
+    entry.update(info)
+    return entry
+
+
+class OutputManifest:
+    """ JSON lines manifest of the outputs saved in a directory. """
+    def __init__(self, directory):
+        self.directory = directory
+        self.fileName = os.path.join(directory, MANIFEST_FILE)
+        self.pendingFileName = os.path.join(directory, PENDING_FILE)
+
+    def getPath(self, entry):
+        return os.path.join(self.directory, entry['filename'])
+
+    def entries(self, fileType=None):
+        """ Entries in the order they were saved. A file saved twice keeps
+        its latest entry.
+        """
+        entries = OrderedDict()
+        if os.path.exists(self.fileName):
+            with open(self.fileName) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        entries[entry['filename']] = entry
+        return [entry for entry in entries.values()
+                if fileType is None or entry['type'] == fileType]
+
+    def getMtime(self, entry):
+        """ Modification time of the file when it was added, or its current
+        one for entries written without it, e.g. by ChimeraX.
+        """
+        if 'mtime' in entry:
+            return entry['mtime']
+        path = self.getPath(entry)
+        return os.path.getmtime(path) if os.path.exists(path) else 0
+
+    def append(self, filename, fileType, **info):
+        path = os.path.join(self.directory, os.path.basename(filename))
+        if os.path.exists(path):
+            info.setdefault('mtime', os.path.getmtime(path))
+        return self._write(manifestEntry(filename, fileType, **info))
+
+    def _write(self, entry):
+        with open(self.fileName, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def _fileEntry(self, filename):
+        """ Entry of a file saved in the directory, with the sampling and
+        origin of maps read from their header.
+        """
+        path = os.path.join(self.directory, filename)
+        mtime = os.path.getmtime(path)
+        if filename.endswith(".mrc"):
+            info = getMapInfo(path)
+            return manifestEntry(filename, VOLUME, sampling=info['sampling'],
+                                 origin=info['origin'], mtime=mtime)
+        return manifestEntry(filename, ATOMSTRUCT, mtime=mtime)
+
+    def _unindexed(self, known):
+        """ Names of the saved files that are not in known. """
+        return [filename for filename in sorted(os.listdir(self.directory))
+                if filename not in known
+                and filename.endswith(('.mrc', '.pdb', '.cif'))]
+
+    def peek(self):
+        """ Entries of the manifest followed by those of the files not
+        added yet, without writing anything, for readers like the viewer.
+        """
+        entries = self.entries()
+        known = set(entry['filename'] for entry in entries)
+        for filename in self._unindexed(known):
+            try:
+                entries.append(self._fileEntry(filename))
+            except Exception:
+                pass  # still being written, shown once it is complete
+        return entries
+
+    def listFiles(self, fileType=None):
+        """ Paths of the saved files, indexed or not, without touching the
+        manifest.
+        """
+        paths = [self.getPath(entry) for entry in self.entries(fileType)]
+        known = set(os.path.basename(path) for path in paths)
+        extensions = {ATOMSTRUCT: ('.pdb', '.cif'), VOLUME: ('.mrc',)}
+        wanted = extensions.get(fileType, ('.mrc', '.pdb', '.cif'))
+        for filename in sorted(os.listdir(self.directory)):
+            if filename not in known and filename.endswith(wanted):
+                paths.append(os.path.join(self.directory, filename))
+        return paths
+
+    def _readPending(self):
+        if not os.path.exists(self.pendingFileName):
+            return {}
+        with open(self.pendingFileName) as f:
+            return json.load(f)
+
+    def update(self, stableOnly=False):
+        """ Add the files that were saved without writing to the manifest,
+        e.g. with scipionwrite. Only files not yet in the manifest are
+        inspected. While they may still be written, stableOnly, a file is
+        only added once its size and modification time are the same as
+        in the previous update. Returns all the entries.
+        """
+        known = set(entry['filename'] for entry in self.entries())
+        previous = self._readPending() if stableOnly else {}
+        pending = {}
+        for filename in self._unindexed(known):
+            path = os.path.join(self.directory, filename)
+            if stableOnly:
+                stat = os.stat(path)
+                pending[filename] = [stat.st_size, stat.st_mtime_ns]
+                if previous.get(filename) != pending[filename]:
+                    continue
+                del pending[filename]
+            self._write(self._fileEntry(filename))
+        if stableOnly:
+            with open(self.pendingFileName, 'w') as f:
+                json.dump(pending, f)
+        return self.entries()
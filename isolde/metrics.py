@@ -0,0 +1,185 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Performance metrics of a protocol run. The protocol records the wall time
+of its steps and the peak memory of itself and its ChimeraX children, and
+every headless ChimeraX run writes its own phase times, timesteps, atom
+count and map size, which are gathered into the same file.
+"""
+
+import functools
+import json
+import os
+import resource
+import sys
+import time
+
+from .constants import METRICS_FILE, CHIMERA_METRICS
+
+# ru_maxrss is reported in bytes on macOS and in KB elsewhere
+RSS_SCALE = 1024.0 ** 2 if sys.platform == 'darwin' else 1024.0
+
+
+def getPeakRss():
+    """ Peak resident memory, in MB, of this process and of the largest
+    of its finished child processes.
+    """
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / RSS_SCALE
+
+
+def valueRange(values):
+    """ "n" if all the values are n, "min-max" otherwise. """
+    values = sorted(set(values))
+    if len(values) == 1:
+        return "%d" % values[0]
+    return "%d-%d" % (values[0], values[-1])
+
+
+def measured(phase):
+    """ Decorator for protocol steps that records their wall time in the
+    metrics file of the protocol extra directory.
+    """
+    def decorator(step):
+        @functools.wraps(step)
+        def wrapper(protocol, *args, **kwargs):
+            start = time.time()
+            try:
+                return step(protocol, *args, **kwargs)
+            finally:
+                RunMetrics(protocol._getExtraPath()).addPhase(
+                    phase, time.time() - start)
+        return wrapper
+    return decorator
+
+
+class RunMetrics:
+    """ JSON metrics file of a run. """
+    def __init__(self, directory):
+        self.fileName = os.path.join(directory, METRICS_FILE)
+
+    def read(self):
+        if not os.path.exists(self.fileName):
+            return {'phases': {}, 'jobs': []}
+        with open(self.fileName) as f:
+            return json.load(f)
+
+    def write(self, metrics):
+        with open(self.fileName, 'w') as f:
+            json.dump(metrics, f, indent=1)
+
+    def addPhase(self, phase, seconds):
+        metrics = self.read()
+        metrics['phases'][phase] = seconds
+        metrics['peakRss'] = max(metrics.get('peakRss', 0), getPeakRss())
+        self.write(metrics)
+
+    def addJobs(self, directories, regions=False):
+        """ Gather the metrics written by the ChimeraX runs in the given
+        directories. Runs that did not finish are skipped. When the runs
+        are regions of one model, their simulated atoms add up.
+        """
+        jobs = []
+        for directory in directories:
+            fileName = os.path.join(directory, CHIMERA_METRICS)
+            if os.path.exists(fileName):
+                with open(fileName) as f:
+                    jobs.append(json.load(f))
+        metrics = self.read()
+        metrics['jobs'] = jobs
+        metrics['regions'] = regions
+        self.write(metrics)
+
+    def addLaunch(self, settings):
+        """ Record the threads, OpenMM platform and cores given to the
+        ChimeraX processes, keeping those of the most concurrent launch.
+        """
+        metrics = self.read()
+        if settings['workers'] >= metrics.get('launch', {}).get('workers', 0):
+            metrics['launch'] = settings
+            self.write(metrics)
+
+    def getSummary(self):
+        """ Lines describing the metrics, empty if there are none. """
+        if not os.path.exists(self.fileName):
+            return []
+        metrics = self.read()
+        lines = []
+        if metrics['phases']:
+            lines.append("Wall time: %s" % ", ".join(
+                "%s %0.1f s" % item for item in metrics['phases'].items()))
+        jobs = metrics['jobs']
+        jobPhases = {}
+        for job in jobs:
+            for phase, seconds in job['phases'].items():
+                jobPhases[phase] = jobPhases.get(phase, 0) + seconds
+        if jobPhases:
+            lines.append("ChimeraX time: %s" % ", ".join(
+                "%s %0.1f s" % item for item in jobPhases.items()))
+        steps = sum(job['steps'] for job in jobs)
+        seconds = sum(job['phases'].get('simulation', 0) for job in jobs)
+        if steps and seconds:
+            throughput = "%0.1f steps/s" % (steps / seconds)
+            timesteps = [job['timestep'] for job in jobs if job['timestep']]
+            if timesteps:
+                # ps per wall second to ns per day
+                throughput += ", %0.2f ns/day" % (
+                    steps * timesteps[0] / seconds * 86400 / 1000)
+            lines.append("Simulation: %d timesteps in %d run%s, %s per run"
+                         % (steps, len(jobs), "" if len(jobs) == 1 else "s",
+                            throughput))
+        if jobs and metrics.get('regions'):
+            lines.append("Atoms: %d simulated in %d regions"
+                         % (sum(job['simulatedAtoms'] for job in jobs),
+                            len(jobs)))
+        elif jobs:
+            # Batch, sweep and staged runs each simulate a whole model
+            lines.append("Atoms: %s (%s simulated)%s"
+                         % (valueRange(job['atoms'] for job in jobs),
+                            valueRange(job['simulatedAtoms'] for job in jobs),
+                            " per run" if len(jobs) > 1 else ""))
+        if jobs:
+            mapSize = jobs[0].get('mapSize')
+            if mapSize:
+                lines.append("Map size: %s voxels"
+                             % "x".join(str(n) for n in mapSize))
+        launch = metrics.get('launch')
+        if launch:
+            line = "ChimeraX processes: %d x %d threads, OpenMM %s" % (
+                launch['workers'], launch['threads'],
+                launch['platform'] or "platform chosen by ISOLDE")
+            if launch['cpus']:
+                line += ", pinned to cores %s" % " | ".join(
+                    ",".join(map(str, cpus)) for cpus in launch['cpus'])
+            lines.append(line)
+        peakRss = max([metrics.get('peakRss', 0)] +
+                      [job['peakRss'] for job in jobs])
+        if peakRss:
+            lines.append("Peak memory: %0.0f MB" % peakRss)
+        return lines
@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Probe of the ChimeraX installation used by the plugin. Starting ChimeraX
+to ask for its version and for the installed ISOLDE bundle takes
+seconds, so the result is kept in a small state file that is only
+refreshed when the ChimeraX binary changes.
+"""
+
+import json
+import os
+import tempfile
+
+from .constants import PROBE_FILE, PROBE_SCRIPT, ISOLDE_MIN_VERSION
+from .utils import getChimeraXProgram, getScript, runHeadlessChimera
+
+
+def versionTuple(version):
+    """ Comparable tuple with the leading numbers of a version string,
+    e.g. (1, 6) for '1.6rc1'.
+    """
+    numbers = []
+    for part in str(version).split('.'):
+        digits = ''
+        for char in part:
+            if not char.isdigit():
+                break
+            digits += char
+        if not digits:
+            break
+        numbers.append(int(digits))
+    return tuple(numbers)
+
+
+def probeChimeraX(stateDir):
+    """ Dict with the ChimeraX program, its modification time and the
+    ChimeraX and ISOLDE versions. The versions are None if the program
+    does not exist or ISOLDE is not installed.
+    """
+    program = getChimeraXProgram()
+    state = {'program': program, 'mtime': None,
+             'chimerax': None, 'isolde': None}
+    if not os.path.exists(program):
+        return state
+    state['mtime'] = os.stat(os.path.realpath(program)).st_mtime
+
+    stateFile = os.path.join(stateDir, PROBE_FILE)
+    if os.path.exists(stateFile):
+        with open(stateFile) as f:
+            cached = json.load(f)
+        if cached['program'] == program and cached['mtime'] == state['mtime']:
+            return cached
+
+    os.makedirs(stateDir, exist_ok=True)
+    fd, tmpName = tempfile.mkstemp(dir=stateDir, suffix='.tmp')
+    os.close(fd)
+    try:
+        runHeadlessChimera(getScript(PROBE_SCRIPT), stateDir,
+                           args=[tmpName], offscreen=False)
+        with open(tmpName) as f:
+            state.update(json.load(f))
+        with open(tmpName, 'w') as f:
+            json.dump(state, f)
+        # Written in place at once so concurrent runs never see a partial file
+        os.replace(tmpName, stateFile)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+    return state
+
+
+def checkChimeraX(state, minVersion=ISOLDE_MIN_VERSION):
+    """ Errors and warnings about the probed installation, as two lists.
+    Only an ISOLDE version older than minVersion is an error; a missing
+    program or bundle may just not have been detected by the probe.
+    """
+    if state['mtime'] is None:
+        return [], ["ChimeraX program not found: %s" % state['program']]
+    if not state['isolde']:
+        return [], ["ISOLDE was not found in ChimeraX %s. Install it "
+                    "with: scipion installb isolde" % state['chimerax']]
+    if versionTuple(state['isolde']) < versionTuple(minVersion):
+        return ["ISOLDE %s is installed in ChimeraX %s, but version %s or "
+                "later is required. Update it with: scipion installb isolde"
+                % (state['isolde'], state['chimerax'], minVersion)], []
+    return [], []
@@ -30,56 +30,118 @@ This module implements a protocol to run ISOLDE from Scipion.
 """
 
 import os
-
-from chimera.constants import CHIMERA_CONFIG_FILE
+import csv
+import itertools
+import json
+import shutil
 
 try:
-    from pwem.objects import AtomStruct
+    from pwem.objects import AtomStruct, SetOfAtomStructs
 except ImportError:
     from pwem.objects import PdbFile as AtomStruct
+    from pwem.objects import SetOfPDBs as SetOfAtomStructs
 
 from pyworkflow.protocol.params import (PointerParam,
-                                        BooleanParam)
+                                        MultiPointerParam,
+                                        BooleanParam,
+                                        EnumParam,
+                                        IntParam,
+                                        FloatParam,
+                                        StringParam)
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from pyworkflow.utils.properties import Message
+import pyworkflow.utils as pwutils
+import pyworkflow.object as pwobj
 
 from pwem.protocols import EMProtocol
-from pwem.objects import Volume
-from pwem.convert.headers import Ccp4Header
+from pwem.objects import Volume, EMFile
 from pwem.objects import Transform
-from pwem.viewers.viewer_chimera import (Chimera,
-                                         sessionFile,
-                                         chimeraMapTemplateFileName,
-                                         chimeraScriptFileName,
-                                         chimeraPdbTemplateFileName)
-from chimera import Plugin as chimera
 
 import configparser
 
+from ..constants import (MODE_INTERACTIVE, MODE_HEADLESS,
+                         STOP_FIXED_STEPS, STOP_CONVERGENCE,
+                         CHIMERA_SCRIPT, HEADLESS_SCRIPT, HEADLESS_MODEL,
+                         DEFAULT_STEPS_PER_FRAME,
+                         SPLIT_NONE, SPLIT_CHAINS, SPLIT_SPATIAL,
+                         REGIONS_DIR, REGIONS_FILE, REGIONS_SCRIPT,
+                         REGION_CROPS,
+                         PREPARED_DIR, PREPARE_SCRIPT, CROP_SCRIPT,
+                         MANIFEST_FILE, TRAJECTORY_DIR, TRAJECTORY_COORDS,
+                         CHECKPOINT_SCRIPT, RESTORE_SCRIPT, CHIMERA_METRICS,
+                         VALIDATE_SCRIPT, FIT_JOBS, FIT_TABLE, FIT_SUMMARY,
+                         RESTRAINTS_SCRIPT, RESTRAINTS_FILE,
+                         STAGES_DIR, FILTER_SCRIPT, OPENMM_PLATFORMS,
+                         PLATFORM_DEFAULT, PLATFORM_SCRIPT, CHIMERA_PID,
+                         SWEEP_DIR, SWEEP_FILE, SWEEP_TABLE)
+from .. import Plugin
+from ..cache import fileKey
+from ..manifest import OutputManifest, manifestEntry, ATOMSTRUCT, VOLUME
+from ..metrics import RunMetrics, measured
+from ..trajectory import getTrajectoryInfo, getTopologyFile
+from ..probe import checkChimeraX
+from ..supervisor import SupervisedProcess
+from ..utils import (getChimeraXProgram, getNumberOfWorkers, getScript,
+                     getLaunchSettings, getLaunchEnviron,
+                     runHeadlessChimera, runHeadlessChimeraJobs)
+
+# The chimera plugin, the ChimeraX viewer helpers and the map header
+# reader are imported where they are used, so that listing the protocols
+# does not load them
+
+
 class ProtIsolde(EMProtocol):
     """ Protocol to run ISOLDE within Chimera """
     _label = 'isolde operate'
 
     # --------------------------- DEFINE param functions --------------------
     def _defineParams(self, form, doHelp=True):
-        """ Define parts of form consisting mainly of two parts
-        1. Input volume and input atomic structure
+        """ Define parts of form consisting mainly of three parts
+        1. Input volume and input atomic structure(s)
         2. Flags for simulation
+        3. Run mode, interactive or headless
         """
         form.addSection(label='Input')
         form.addParam('inputVolume', PointerParam, pointerClass="Volume",
                       label='Input Volume', allowsNull=False,
                       important=True,
                       help="Volume to process")
+        form.addParam('useSet', BooleanParam, default=False,
+                      label='Refine several structures',
+                      help="Refine several atomic structures instead of a "
+                           "single one. They are refined in headless mode "
+                           "by concurrent ChimeraX workers.")
         form.addParam('pdbFileToBeRefined', PointerParam,
                       pointerClass="AtomStruct", allowsNull=False,
                       important=True,
+                      condition='not useSet',
                       label='Atomic structure',
                       help="PDBx/mmCIF file that you can save after operating "
                            "with it.")
+        form.addParam('inputStructures', MultiPointerParam,
+                      pointerClass="SetOfAtomStructs,AtomStruct",
+                      minNumObjects=1, allowsNull=False,
+                      important=True,
+                      condition='useSet',
+                      label='Atomic structures',
+                      help="Sets of atomic structures and/or single "
+                           "structures. A structure with an associated "
+                           "volume is refined against that volume, the "
+                           "rest against the input volume.")
         form.addParam('addH', BooleanParam,
                       label='Add hydrogens to PDB', allowsNull=True,
                       default = True,
                       help="Automatically add hydrogens to PDB")
+        form.addParam('usePrepCache', BooleanParam, default=True,
+                      condition='addH',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reuse prepared models',
+                      help="Add the hydrogens in a preparation step whose "
+                           "result is kept in a cache shared by all runs "
+                           "(ISOLDE_CACHE, ~/.cache/scipion-isolde by "
+                           "default, limited to ISOLDE_CACHE_SIZE MB). "
+                           "A structure already prepared by a previous run "
+                           "is not prepared again.")
         form.addParam('hideHC', BooleanParam,
                       label='Hide non-polar hydrogens', allowsNull=True,
                       default=True,
@@ -89,6 +151,283 @@ class ProtIsolde(EMProtocol):
                       default=True,
                       help="Automatically restrain ligands in simulation to"
                             " avoid them being sent away flying")
+        form.addParam('referenceModel', PointerParam,
+                      pointerClass="AtomStruct", allowsNull=True,
+                      condition='not useSet',
+                      label='Reference structure',
+                      help="Optional higher resolution structure of the "
+                           "same molecule. Restraints to it are generated "
+                           "once, saved in the extra directory and in the "
+                           "cache of prepared models, and loaded in every "
+                           "session on this model.")
+        form.addParam('restrainDistances', BooleanParam, default=True,
+                      condition='not useSet and referenceModel',
+                      label='Reference distance restraints',
+                      help="Restrain the distances between atoms to those "
+                           "in the reference structure.")
+        form.addParam('distanceCutoff', FloatParam, default=8.0,
+                      condition='not useSet and referenceModel and '
+                                'restrainDistances',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Distance cutoff (A)',
+                      help="Only atom pairs closer than this in the "
+                           "reference are restrained.")
+        form.addParam('restrainTorsions', BooleanParam, default=True,
+                      condition='not useSet and referenceModel',
+                      label='Reference torsion restraints',
+                      help="Restrain the backbone and side chain torsions "
+                           "to those in the reference structure.")
+        form.addParam('angleRange', FloatParam, default=150.0,
+                      condition='not useSet and referenceModel and '
+                                'restrainTorsions',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Torsion range (deg)',
+                      help="Torsions further than this from the reference "
+                           "are not restrained.")
+        form.addParam('cropMap', BooleanParam, default=False,
+                      label='Box map around the model',
+                      help="Crop the map to the bounding box of the model "
+                           "plus a padding before associating them, so "
+                           "ISOLDE only loads the density it needs. Useful "
+                           "for large maps and small models.")
+        form.addParam('cropPadding', FloatParam, default=10.0,
+                      condition='cropMap',
+                      label='Padding (A)',
+                      help="Margin added around the model bounding box.")
+        form.addParam('voxelSize', FloatParam, default=0.0,
+                      condition='cropMap',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Resample to voxel size (A)',
+                      help="Resample the boxed map to this voxel size. "
+                           "Use 0 to keep the voxel size of the input map.")
+
+        headless = 'useSet or runMode == %d' % MODE_HEADLESS
+        form.addSection(label='Simulation')
+        form.addParam('runMode', EnumParam,
+                      choices=['interactive', 'headless'],
+                      default=MODE_INTERACTIVE,
+                      display=EnumParam.DISPLAY_HLIST,
+                      condition='not useSet',
+                      label='Run mode',
+                      help="interactive: open a ChimeraX session where the "
+                           "model is refined by hand and saved with "
+                           "scipionwrite.\n"
+                           "headless: run ChimeraX without graphics, "
+                           "simulate, save the refined model and exit. "
+                           "No display is needed.")
+        form.addParam('streamOutputs', BooleanParam, default=False,
+                      condition='not useSet and runMode == %d'
+                                % MODE_INTERACTIVE,
+                      label='Register outputs while refining',
+                      help="Keep the protocol running while the ChimeraX "
+                           "session is open and register every model or "
+                           "map saved with scipionwrite as soon as it is "
+                           "written, so other protocols can use it before "
+                           "the session is closed.")
+        form.addParam('streamInterval', IntParam, default=10,
+                      condition='not useSet and runMode == %d and '
+                                'streamOutputs' % MODE_INTERACTIVE,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Check for new outputs every (s)')
+        form.addParam('stopCriterion', EnumParam,
+                      choices=['fixed steps', 'convergence'],
+                      default=STOP_FIXED_STEPS,
+                      display=EnumParam.DISPLAY_HLIST,
+                      condition=headless,
+                      label='Stop simulation after',
+                      help="fixed steps: run exactly the number of timesteps "
+                           "given below.\n"
+                           "convergence: stop when the RMS atomic shift "
+                           "between two checks falls below the tolerance, "
+                           "or when the number of timesteps is reached.")
+        form.addParam('simSteps', IntParam, default=5000,
+                      condition=headless,
+                      label='Number of timesteps',
+                      help="Timesteps to simulate. When stopping at "
+                           "convergence this is the upper limit.")
+        form.addParam('checkSteps', IntParam, default=500,
+                      condition='(%s) and stopCriterion == %d'
+                                % (headless, STOP_CONVERGENCE),
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Check convergence every (timesteps)')
+        form.addParam('convergenceTol', FloatParam, default=0.01,
+                      condition='(%s) and stopCriterion == %d'
+                                % (headless, STOP_CONVERGENCE),
+                      label='Convergence tolerance (A)',
+                      help="RMS displacement of the atoms between two "
+                           "consecutive checks below which the model is "
+                           "considered converged.")
+        staged = 'not useSet and runMode == %d and staged' % MODE_HEADLESS
+        form.addParam('staged', BooleanParam, default=False,
+                      condition='not useSet and runMode == %d'
+                                % MODE_HEADLESS,
+                      label='Coarse-to-fine refinement',
+                      help="First settle the model against a binned and "
+                           "low-pass filtered copy of the map, where it "
+                           "converges faster, then continue against the "
+                           "full resolution map and any additional maps.")
+        form.addParam('coarseResolution', FloatParam, default=6.0,
+                      condition=staged,
+                      label='Coarse map resolution (A)',
+                      help="Resolution the map is low-pass filtered to "
+                           "with a Gaussian. Use 0 to not filter it.")
+        form.addParam('coarseBinning', IntParam, default=2,
+                      condition=staged,
+                      label='Coarse map binning',
+                      help="Voxels averaged along each axis to downsample "
+                           "the map. Use 1 to keep the sampling.")
+        form.addParam('coarseSteps', IntParam, default=2000,
+                      condition=staged,
+                      label='Coarse timesteps',
+                      help="Timesteps simulated against the coarse map, "
+                           "with the same stop criterion as the final "
+                           "stage.")
+        form.addParam('stageMaps', MultiPointerParam, pointerClass="Volume",
+                      allowsNull=True,
+                      condition=staged,
+                      label='Additional maps',
+                      help="Optional maps, e.g. half maps, associated with "
+                           "the model together with the input volume in "
+                           "the final stage.")
+        form.addParam('sweep', BooleanParam, default=False,
+                      condition='not useSet and runMode == %d'
+                                % MODE_HEADLESS,
+                      label='Sweep simulation settings',
+                      help="Refine the model once for every combination of "
+                           "the settings below, as concurrent headless "
+                           "jobs over the same prepared inputs. The fit, "
+                           "geometry and runtime of every combination are "
+                           "collected in one table and the refined models "
+                           "in one output set.")
+        sweep = 'not useSet and runMode == %d and sweep' % MODE_HEADLESS
+        form.addParam('sweepMapWeights', StringParam, default='0.5 1 2',
+                      condition=sweep,
+                      label='Map weight factors',
+                      help="Factors applied to the map weight chosen by "
+                           "ISOLDE, separated by spaces or commas. Leave "
+                           "empty to keep the weight of ISOLDE.")
+        form.addParam('sweepTemperatures', StringParam, default='',
+                      condition=sweep,
+                      label='Temperatures (K)',
+                      help="Simulation temperatures, separated by spaces or "
+                           "commas. Leave empty to keep the temperature of "
+                           "ISOLDE.")
+        form.addParam('sweepAddH', BooleanParam, default=False,
+                      condition=sweep,
+                      label='Try with and without hydrogens',
+                      help="Refine every combination both adding hydrogens "
+                           "and not. Otherwise the setting above is used.")
+        form.addParam('sweepLigands', BooleanParam, default=False,
+                      condition=sweep,
+                      label='Try with and without ligand restraints',
+                      help="Refine every combination both restraining "
+                           "ligands and not. Otherwise the setting above is "
+                           "used.")
+        form.addParam('checkpoint', BooleanParam, default=False,
+                      label='Checkpoint coordinates',
+                      help="Periodically store the coordinates of the model "
+                           "while it is simulated. Frames are kept as "
+                           "float32 arrays next to a single topology file "
+                           "and the trajectory is registered as an output.")
+        form.addParam('checkpointInterval', IntParam, default=1000,
+                      condition='checkpoint',
+                      label='Checkpoint every (timesteps)')
+        form.addParam('resume', BooleanParam, default=False,
+                      condition='not useSet',
+                      label='Resume from last checkpoint',
+                      help="When the protocol is launched again, e.g. after "
+                           "a crash, start from the most recent checkpoint "
+                           "or saved model found in its extra directory "
+                           "instead of the input structure. The map "
+                           "association and restraints are set up again.")
+        form.addParam('splitMode', EnumParam,
+                      choices=['whole model', 'per chain', 'spatial regions'],
+                      default=SPLIT_NONE,
+                      display=EnumParam.DISPLAY_HLIST,
+                      condition='not useSet and runMode == %d'
+                                % MODE_HEADLESS,
+                      label='Simulate',
+                      help="whole model: simulate all the atoms at once.\n"
+                           "per chain: simulate each chain on its own.\n"
+                           "spatial regions: simulate cubic regions of the "
+                           "model on their own.\n"
+                           "Regions are simulated in parallel with the "
+                           "atoms around them held fixed, and the refined "
+                           "coordinates are merged back into one model. "
+                           "This bounds the memory of each ChimeraX "
+                           "process for very large assemblies.")
+        split = 'not useSet and runMode == %d and splitMode != %d' \
+                % (MODE_HEADLESS, SPLIT_NONE)
+        form.addParam('regionSize', FloatParam, default=40.0,
+                      condition='not useSet and runMode == %d and '
+                                'splitMode == %d'
+                                % (MODE_HEADLESS, SPLIT_SPATIAL),
+                      label='Region size (A)',
+                      help="Edge of the cubic cells used to group residues "
+                           "in regions.")
+        form.addParam('shellRadius', FloatParam, default=8.0,
+                      condition=split,
+                      label='Fixed shell (A)',
+                      help="Residues within this distance of a region are "
+                           "included in its simulation but kept fixed. "
+                           "Each region job only loads these atoms and the "
+                           "map boxed around them.")
+        workers = 'useSet or (%s) or (%s)' % (split, sweep)
+        form.addParam('numberOfWorkers', IntParam, default=2,
+                      condition=workers,
+                      label='Concurrent ChimeraX workers',
+                      help="Maximum number of headless ChimeraX sessions "
+                           "running at the same time. It is further limited "
+                           "by the number of threads of the protocol, the "
+                           "number of cores and the free memory.")
+        form.addParam('workerMemory', FloatParam, default=4.0,
+                      condition=workers,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Memory per worker (GB)',
+                      help="Expected memory footprint of one ChimeraX "
+                           "worker, used to bound the number of concurrent "
+                           "workers. Use 0 to ignore the memory.")
+        form.addParam('fitMetrics', BooleanParam, default=False,
+                      label='Compute fit metrics',
+                      help="After the refinement, compute the per-residue "
+                           "density fit, clashes and Ramachandran and "
+                           "rotamer outliers of every refined model in a "
+                           "single headless ChimeraX session. The table is "
+                           "registered as an output and summarized. Always "
+                           "done for a sweep, which is ranked by them. If "
+                           "the metrics fail the outputs are still "
+                           "registered.")
+        form.addParam('openmmPlatform', EnumParam,
+                      choices=['default', 'CPU', 'OpenCL', 'CUDA'],
+                      default=PLATFORM_DEFAULT,
+                      display=EnumParam.DISPLAY_HLIST,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='OpenMM platform',
+                      help="Platform the simulations run on. default lets "
+                           "ISOLDE choose, usually a GPU when there is "
+                           "one. On CPU nodes each ChimeraX process uses "
+                           "the threads of the protocol divided among the "
+                           "concurrent workers.")
+        form.addParam('pinCpus', BooleanParam, default=False,
+                      condition='useSet or runMode == %d' % MODE_HEADLESS,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Pin workers to cores',
+                      help="Bind every headless ChimeraX process to its own "
+                           "set of cores, as many as its threads, so that "
+                           "concurrent sessions do not compete for them.")
+        form.addParam('wallTimeLimit', FloatParam, default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='ChimeraX time limit (h)',
+                      help="Stop any ChimeraX process of the protocol, and "
+                           "fail the step, after running this long. Use 0 "
+                           "for no limit.")
+        form.addParam('memoryLimit', FloatParam, default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='ChimeraX memory limit (GB)',
+                      help="Stop any ChimeraX process of the protocol, and "
+                           "fail the step, when its resident memory grows "
+                           "beyond this. Use 0 for no limit.")
+        form.addParallelSection(threads=4, mpi=0)
         if doHelp:
             form.addSection(label='Help')
             form.addLine('''To save: scipionwrite [model #n] [prefix stringAddedToFilename]
@@ -99,14 +438,250 @@ class ProtIsolde(EMProtocol):
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep('runChimeraStep')
+        if self.usesPrepCache():
+            self._insertFunctionStep('prepareInputStep')
+        if self.cropMap:
+            self._insertFunctionStep('prepareMapStep')
+        if self.usesReferenceRestraints():
+            self._insertFunctionStep('prepareRestraintsStep')
+        if self.useSet:
+            self._insertFunctionStep('runBatchStep')
+        elif self.isSplit():
+            self._insertFunctionStep('planRegionsStep')
+            self._insertFunctionStep('runRegionsStep')
+            self._insertFunctionStep('mergeRegionsStep')
+        elif self.isStaged():
+            self._insertFunctionStep('prepareCoarseMapStep')
+            self._insertFunctionStep('runStagesStep')
+        elif self.isSweep():
+            self._insertFunctionStep('runSweepStep')
+        else:
+            self._insertFunctionStep('runChimeraStep')
+        # The sweep is ranked by the fit metrics
+        if self.fitMetrics or self.isSweep():
+            self._insertFunctionStep('fitMetricsStep')
+        if self.isSweep():
+            self._insertFunctionStep('collectSweepStep')
         self._insertFunctionStep('createOutputStep')
     # --------------------------- STEPS functions -----------------------------
+    @measured('prepareInput')
+    def prepareInputStep(self):
+        """ Add hydrogens to the input structures, reusing the models
+        prepared by any previous run from the same files.
+        """
+        cache = Plugin.getPrepCache()
+        preparedDir = self._getExtraPath(PREPARED_DIR)
+        pwutils.makePath(preparedDir)
+        jobs = []
+        keys = []
+        for i, pdbFileName in enumerate(self._getInputModels()):
+            key = fileKey(pdbFileName, addH=True)
+            preparedFile = os.path.abspath(self._getPreparedModel(i))
+            cachedFile = cache.get(key)
+            if cachedFile:
+                self.info("Reusing prepared model %s" % cachedFile)
+                shutil.copyfile(cachedFile, preparedFile)
+            else:
+                jobs.append((getScript(PREPARE_SCRIPT), preparedDir,
+                             [os.path.abspath(pdbFileName), preparedFile]))
+                keys.append((key, preparedFile))
+
+        if jobs:
+            self._runChimeraJobs(jobs)
+            for key, preparedFile in keys:
+                self._putInCache(cache, key, preparedFile)
+
+    @measured('prepareMap')
+    def prepareMapStep(self):
+        """ Box every map around its model, resampling it if requested,
+        and make sure the origin is kept in the MRC header.
+        """
+        preparedDir = self._getExtraPath(PREPARED_DIR)
+        pwutils.makePath(preparedDir)
+        jobs = []
+        for i, (pdbFileName, volFileName) in \
+                enumerate(self._getInputPairs()):
+            args = [os.path.abspath(pdbFileName),
+                    os.path.abspath(volFileName),
+                    os.path.abspath(self._getCroppedMap(i)),
+                    self.cropPadding.get()]
+            if self.voxelSize.get() > 0:
+                args.append(self.voxelSize.get())
+            jobs.append((getScript(CROP_SCRIPT), preparedDir, args))
+        self._runChimeraJobs(jobs)
+
+        for i in range(len(jobs)):
+            self._setMapOrigin(self._getCroppedMap(i))
+
+    @measured('prepareCoarseMap')
+    def prepareCoarseMapStep(self):
+        """ Bin and low-pass filter the map for the first stage of a
+        coarse-to-fine refinement.
+        """
+        preparedDir = self._getExtraPath(PREPARED_DIR)
+        pwutils.makePath(preparedDir)
+        volFileName = self._getCroppedMap(0) if self.cropMap \
+            else self.inputVolume.get().getFileName()
+        self._runChimera(getScript(FILTER_SCRIPT), preparedDir,
+                         args=[os.path.abspath(volFileName),
+                               os.path.abspath(self._getCoarseMap()),
+                               self.coarseResolution.get(),
+                               self.coarseBinning.get()])
+        self._setMapOrigin(self._getCoarseMap())
+
+    @measured('simulation')
+    def runStagesStep(self):
+        """ Simulate the model against the coarse map and then, starting
+        from the coarse result, against the full map and the additional
+        maps. The final model is saved in the extra dir.
+        """
+        coarseDir = self._getStagePath('coarse')
+        pwutils.makePath(coarseDir)
+        fnCmd = self._writeHeadlessScript(coarseDir,
+                                          volFileName=self._getCoarseMap(),
+                                          simSteps=self.coarseSteps.get())
+        self.info("Coarse stage against %s" % self._getCoarseMap())
+        self._runChimera(fnCmd, coarseDir)
+
+        extraVolFileNames = [pointer.get().getFileName()
+                             for pointer in self.stageMaps]
+        fnCmd = self._writeHeadlessScript(
+            pdbFileName=os.path.join(coarseDir, HEADLESS_MODEL),
+            prepared=True, extraVolFileNames=extraVolFileNames)
+        self.info("Final stage against %d map(s)"
+                  % (1 + len(extraVolFileNames)))
+        self._runChimera(fnCmd, self._getExtraPath())
+
+    @measured('simulation')
+    def runSweepStep(self):
+        """ Refine the model once for every combination of the swept
+        settings, several combinations at the same time. The combinations
+        that fail are reported and left out of the comparison.
+        """
+        volFileName = self._getCroppedMap(0) if self.cropMap else None
+        inputFileName = self.pdbFileToBeRefined.get().getFileName()
+        variants = self._getSweepVariants()
+        jobs = []
+        for i, variant in enumerate(variants):
+            jobDir = self._getSweepPath(i)
+            pwutils.makePath(jobDir)
+            # Hydrogenated once in prepareInputStep for all combinations
+            prepared = variant['addH'] and self.usesPrepCache()
+            pdbFileName = self._getPreparedModel(0) if prepared \
+                else inputFileName
+            fnCmd = self._writeHeadlessScript(jobDir, pdbFileName,
+                                              volFileName, prepared=prepared,
+                                              variant=variant)
+            jobs.append((fnCmd, jobDir))
+        with open(self._getExtraPath(SWEEP_FILE), 'w') as f:
+            json.dump(variants, f, indent=1)
+
+        numberOfWorkers = self._getNumberOfWorkers()
+        self.info("Sweeping %d combinations with %d concurrent workers"
+                  % (len(jobs), numberOfWorkers))
+        try:
+            self._runChimeraJobs(jobs, numberOfWorkers)
+        except Exception as e:
+            if not any(os.path.exists(self._getSweepPath(i, HEADLESS_MODEL))
+                       for i in range(len(jobs))):
+                raise
+            self.warning(str(e))
+
+    @measured('collectSweep')
+    def collectSweepStep(self):
+        """ Write one row per combination of the sweep with its settings,
+        fit and geometry scores and runtime.
+        """
+        fits = {}
+        if os.path.exists(self._getExtraPath(FIT_SUMMARY)):
+            with open(self._getExtraPath(FIT_SUMMARY)) as f:
+                fits = json.load(f)
+        fields = ['name', 'mapWeight', 'temperature', 'addH',
+                  'restrainLigands', 'density', 'clashscore',
+                  'ramaOutliers', 'rotamerOutliers', 'steps',
+                  'simulationTime', 'totalTime']
+        with open(self._getExtraPath(SWEEP_TABLE), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields,
+                                    extrasaction='ignore')
+            writer.writeheader()
+            for i, variant in enumerate(self._readSweepVariants()):
+                row = dict(variant, name=self._getSweepName(i))
+                row.update(fits.get(self._getSweepFitName(i), {}))
+                metricsFile = self._getSweepPath(i, CHIMERA_METRICS)
+                if os.path.exists(metricsFile):
+                    with open(metricsFile) as mf:
+                        metrics = json.load(mf)
+                    row['steps'] = metrics['steps']
+                    row['simulationTime'] = \
+                        metrics['phases'].get('simulation', 0)
+                    row['totalTime'] = sum(metrics['phases'].values())
+                writer.writerow(row)
+
+    def _putInCache(self, cache, key, fileName, extension='.cif'):
+        """ Store a prepared file in the cache shared by all the runs. The
+        run goes on with its own copy if the cache can not be written.
+        """
+        try:
+            cache.put(key, fileName, extension)
+        except OSError as e:
+            self.warning("Could not store %s in the cache %s: %s"
+                         % (fileName, cache.path, e))
+
+    def _setMapOrigin(self, volFileName):
+        """ Write in the MRC header the origin that ChimeraX reported for a
+        map it saved.
+        """
+        from pwem.convert.headers import Ccp4Header
+        with open(pwutils.replaceExt(volFileName, 'json')) as f:
+            origin = json.load(f)['origin']
+        ccp4header = Ccp4Header(volFileName, readHeader=True)
+        ccp4header.setOrigin(origin)
+        ccp4header.writeHeader()
+
+    @measured('prepareRestraints')
+    def prepareRestraintsStep(self):
+        """ Restrain the model to the reference structure, reusing the
+        restraints generated by any previous run for the same files and
+        options.
+        """
+        cache = Plugin.getPrepCache()
+        pdbFileName = self.pdbFileToBeRefined.get().getFileName()
+        referenceFileName = self.referenceModel.get().getFileName()
+        key = fileKey(pdbFileName, reference=fileKey(referenceFileName),
+                      distances=bool(self.restrainDistances),
+                      torsions=bool(self.restrainTorsions),
+                      distanceCutoff=self.distanceCutoff.get(),
+                      angleRange=self.angleRange.get())
+        restraintsFile = os.path.abspath(self._getExtraPath(RESTRAINTS_FILE))
+        cachedFile = cache.get(key, '.json')
+        if cachedFile:
+            self.info("Reusing reference restraints %s" % cachedFile)
+            shutil.copyfile(cachedFile, restraintsFile)
+            return
+
+        self._runChimera(getScript(RESTRAINTS_SCRIPT), self._getExtraPath(),
+                         args=['generate', os.path.abspath(pdbFileName),
+                               os.path.abspath(referenceFileName),
+                               restraintsFile,
+                               int(bool(self.restrainDistances)),
+                               int(bool(self.restrainTorsions)),
+                               self.distanceCutoff.get(),
+                               self.angleRange.get()])
+        self._putInCache(cache, key, restraintsFile, '.json')
+
+    @measured('simulation')
     def runChimeraStep(self):
         """ Run Chimera script to start simulation and enable scipionwrite
         """
-        self.writeChimeraScript()
-        fnCmd = os.path.abspath(self._getExtraPath('chimera_script.cxc'))
+        from chimera.constants import CHIMERA_CONFIG_FILE
+        from pwem.viewers.viewer_chimera import (sessionFile,
+                                                 chimeraMapTemplateFileName,
+                                                 chimeraPdbTemplateFileName)
+        resumeSource = self._getResumeSource()
+        if resumeSource:
+            self.info("Resuming from %s" % (resumeSource[1]
+                                            or resumeSource[0]))
+        fnCmd = os.path.abspath(self.writeChimeraScript())
 
         # Go to extra dir and save there the output of
         # scipionwrite
@@ -139,42 +714,172 @@ class ProtIsolde(EMProtocol):
             config.write(configfile)
 
         cwd = os.path.abspath(self._getExtraPath())
-        Chimera.runProgram(chimera.getProgram(), fnCmd + "&", cwd=cwd)
+        if self.isHeadless():
+            # Blocks until the simulation has finished and ChimeraX exits
+            self._runChimera(fnCmd, cwd)
+        else:
+            self._runInteractive(fnCmd, cwd)
 
-    def createOutputStep(self):
-        """ Copy the PDB structure and register the output object.
+    @measured('simulation')
+    def runBatchStep(self):
+        """ Refine every input structure in its own extra subdirectory,
+        running several headless ChimeraX workers at the same time. The
+        structures that fail are reported and left out of the output, and
+        those already refined by a previous launch are not run again.
         """
+        jobs = []
+        prepared = self.usesPrepCache()
+        refinementJobs = self.getRefinementJobs()
+        for i, (pdbFileName, volFileName) in enumerate(refinementJobs):
+            jobDir = self._getJobPath(i)
+            if os.path.exists(self._getJobPath(i, HEADLESS_MODEL)):
+                self.info("Structure %d was already refined in %s"
+                          % (i + 1, jobDir))
+                continue
+            pwutils.makePath(jobDir)
+            if prepared:
+                pdbFileName = self._getPreparedModel(i)
+            if self.cropMap:
+                volFileName = self._getCroppedMap(i)
+            fnCmd = self._writeHeadlessScript(jobDir, pdbFileName,
+                                              volFileName, prepared=prepared)
+            jobs.append((fnCmd, jobDir))
 
-        # Check vol and pdb files
-        directory = self._getExtraPath()
-        for filename in sorted(os.listdir(directory)):
-            if filename.endswith(".mrc"):
-                volFileName = os.path.join(directory, filename)
-                vol = Volume()
-                vol.setFileName(volFileName)
+        if not jobs:
+            return
+        numberOfWorkers = self._getNumberOfWorkers()
+        self.info("Refining %d structures with %d concurrent workers"
+                  % (len(jobs), numberOfWorkers))
+        try:
+            self._runChimeraJobs(jobs, numberOfWorkers)
+        except Exception as e:
+            if not any(os.path.exists(self._getJobPath(i, HEADLESS_MODEL))
+                       for i in range(len(refinementJobs))):
+                raise
+            self.warning(str(e))
 
-                # fix mrc header
-                ccp4header = Ccp4Header(volFileName, readHeader=True)
-                sampling = ccp4header.computeSampling()
-                origin = Transform()
-                shifts = ccp4header.getOrigin()
-                origin.setShiftsTuple(shifts)
-                vol.setOrigin(origin)
-                vol.setSamplingRate(sampling)
-                keyword = filename.split(".mrc")[0]
-                kwargs = {keyword: vol}
-                self._defineOutputs(**kwargs)
+    @measured('planRegions')
+    def planRegionsStep(self):
+        """ Split the model in chains or spatial regions. The model is
+        hydrogenated once here so that all regions share the same atoms.
+        Every region, with its shell, is saved as a model of its own and
+        the map is boxed around it, so that each region job only loads
+        its part of the model and of the map.
+        """
+        regionsDir = self._getExtraPath(REGIONS_DIR)
+        pwutils.makePath(regionsDir)
+        pdbFileName = self._getPreparedModel(0) if self.usesPrepCache() \
+            else self.pdbFileToBeRefined.get().getFileName()
+        args = [os.path.abspath(pdbFileName),
+                os.path.abspath(self._getRegionsFile()),
+                'chain' if self.splitMode.get() == SPLIT_CHAINS
+                else 'spatial',
+                self.regionSize.get(),
+                self.shellRadius.get()]
+        if self.addH and not self.usesPrepCache():
+            args.append('addh')
+        self._runChimera(getScript(REGIONS_SCRIPT), regionsDir,
+                         args=['plan'] + args)
 
-            if filename.endswith(".pdb") or filename.endswith(".cif"):
-                path = os.path.join(directory, filename)
-                pdb = AtomStruct()
-                pdb.setFileName(path)
-                if filename.endswith(".cif"):
-                    keyword = filename.split(".cif")[0].replace(".","_")
-                else:
-                    keyword = filename.split(".pdb")[0].replace(".", "_")
-                kwargs = {keyword: pdb}
-                self._defineOutputs(**kwargs)
+        plan = self._readRegions()
+        for region in plan['regions']:
+            region['map'] = os.path.abspath(os.path.join(
+                regionsDir, '%s.mrc' % region['name']))
+        with open(self._getRegionsFile(), 'w') as f:
+            json.dump(plan, f, indent=1)
+        cropsFile = os.path.join(regionsDir, REGION_CROPS)
+        with open(cropsFile, 'w') as f:
+            json.dump([{'model': region['model'], 'output': region['map']}
+                       for region in plan['regions']], f, indent=1)
+        # A single session reads the whole map for all the regions
+        volFileName = self._getCroppedMap(0) if self.cropMap \
+            else self.inputVolume.get().getFileName()
+        self._runChimera(getScript(CROP_SCRIPT), regionsDir,
+                         args=['batch', os.path.abspath(cropsFile),
+                               os.path.abspath(volFileName),
+                               self.cropPadding.get()])
+        for region in plan['regions']:
+            self._setMapOrigin(region['map'])
+
+    @measured('simulation')
+    def runRegionsStep(self):
+        """ Simulate every region, with a fixed shell around it, in
+        concurrent headless ChimeraX workers.
+        """
+        plan = self._readRegions()
+        jobs = []
+        for i, region in enumerate(plan['regions']):
+            regionDir = self._getExtraPath(REGIONS_DIR, 'region_%03d' % i)
+            pwutils.makePath(regionDir)
+            fnCmd = self._writeHeadlessScript(regionDir, region['model'],
+                                              region['map'],
+                                              simSpec='#1' + region['spec'],
+                                              prepared=True)
+            jobs.append((fnCmd, regionDir))
+            region['output'] = os.path.abspath(
+                os.path.join(regionDir, HEADLESS_MODEL))
+        with open(self._getRegionsFile(), 'w') as f:
+            json.dump(plan, f, indent=1)
+
+        numberOfWorkers = self._getNumberOfWorkers()
+        self.info("Simulating %d regions with %d concurrent workers"
+                  % (len(jobs), numberOfWorkers))
+        self._runChimeraJobs(jobs, numberOfWorkers)
+
+    @measured('mergeRegions')
+    def mergeRegionsStep(self):
+        """ Merge the refined regions into a single mmCIF file. """
+        self._runChimera(getScript(REGIONS_SCRIPT),
+                         self._getExtraPath(REGIONS_DIR),
+                         args=['merge',
+                               os.path.abspath(self._getRegionsFile()),
+                               os.path.abspath(
+                                 self._getExtraPath(HEADLESS_MODEL))])
+        OutputManifest(self._getExtraPath()).append(HEADLESS_MODEL,
+                                                    ATOMSTRUCT)
+
+    @measured('fitMetrics')
+    def fitMetricsStep(self):
+        """ Validate all the refined models against their maps in a single
+        headless ChimeraX session.
+        """
+        jobs = self._getFitJobs()
+        if not jobs:
+            self.info("No refined models to validate")
+            return
+        jobsFile = self._getExtraPath(FIT_JOBS)
+        with open(jobsFile, 'w') as f:
+            json.dump(jobs, f, indent=1)
+        args = [jobsFile, self._getExtraPath(FIT_TABLE),
+                self._getExtraPath(FIT_SUMMARY)]
+        # The metrics are extra information, they never block the outputs
+        try:
+            self._runChimera(getScript(VALIDATE_SCRIPT),
+                             self._getExtraPath(),
+                             args=[os.path.abspath(arg) for arg in args])
+        except Exception as e:
+            self.warning("Could not compute the fit metrics: %s" % e)
+
+    @measured('createOutput')
+    def createOutputStep(self):
+        """ Copy the PDB structure and register the output object.
+        """
+        from chimera.constants import CHIMERA_CONFIG_FILE
+        RunMetrics(self._getExtraPath()).addJobs(self._getRunDirs(),
+                                                 regions=self.isSplit())
+        self._createFitMetricsOutput()
+        if self.useSet:
+            self._createBatchOutput()
+            return
+        if self.isSweep():
+            self._createSweepOutput()
+            return
+
+        self._registerOutputs()
+        self._createTrajectoryOutput()
+        # Only runChimeraStep writes a ChimeraX config to update
+        if self.isSplit() or self.isStaged():
+            return
 
         # upodate config file flag enablebundle
         # so scipionwrite is disabled
@@ -185,34 +890,643 @@ class ProtIsolde(EMProtocol):
                   'w') as configfile:
             config.write(configfile)
 
+    def _registerOutputs(self, stableOnly=False):
+        """ Register the vol and pdb files saved in the manifest that are
+        not outputs yet. While the session is open, stableOnly, files that
+        may still be being written are left for a later call. Returns the
+        number of new outputs.
+        """
+        newOutputs = 0
+        manifest = OutputManifest(self._getExtraPath())
+        for entry in manifest.update(stableOnly=stableOnly):
+            if self.hasAttribute(entry['keyword']):
+                continue
+            path = manifest.getPath(entry)
+            if entry['type'] == VOLUME:
+                vol = Volume()
+                vol.setFileName(path)
+                origin = Transform()
+                origin.setShiftsTuple(entry['origin'])
+                vol.setOrigin(origin)
+                vol.setSamplingRate(entry['sampling'])
+                kwargs = {entry['keyword']: vol}
+                self._defineOutputs(**kwargs)
+            else:
+                pdb = AtomStruct()
+                pdb.setFileName(path)
+                kwargs = {entry['keyword']: pdb}
+                self._defineOutputs(**kwargs)
+            newOutputs += 1
+        return newOutputs
+
+    def _createTrajectoryOutput(self):
+        """ Register the checkpointed coordinates, if any. """
+        trajectoryDir = self._getExtraPath(TRAJECTORY_DIR)
+        if getTrajectoryInfo(trajectoryDir) is None:
+            return
+        trajectory = EMFile(filename=os.path.join(trajectoryDir,
+                                                  TRAJECTORY_COORDS))
+        topology = AtomStruct(filename=getTopologyFile(trajectoryDir))
+        self._defineOutputs(outputTrajectory=trajectory,
+                            outputTrajectoryTopology=topology)
+
+    def _createSweepOutput(self):
+        """ Register the refined model of every combination of the sweep in
+        a single set, with its settings and scores, and the results table.
+        """
+        outputSet = self._createSetOfPDBs()
+        with open(self._getExtraPath(SWEEP_TABLE)) as f:
+            for row in csv.DictReader(f):
+                fileName = self._getExtraPath(SWEEP_DIR, row['name'],
+                                              HEADLESS_MODEL)
+                if not os.path.exists(fileName):
+                    continue
+                struct = AtomStruct(filename=fileName)
+                for key in ['mapWeight', 'temperature', 'density',
+                            'clashscore', 'simulationTime']:
+                    setattr(struct, '_isolde_%s' % key,
+                            pwobj.Float(row[key] or None))
+                for key in ['addH', 'restrainLigands']:
+                    setattr(struct, '_isolde_%s' % key,
+                            pwobj.Boolean(row[key] == 'True'))
+                outputSet.append(struct)
+        self._defineOutputs(outputAtomStructs=outputSet,
+                            outputSweepResults=EMFile(
+                                filename=self._getExtraPath(SWEEP_TABLE)))
+        self._defineSourceRelation(self.pdbFileToBeRefined, outputSet)
+
+    def _createFitMetricsOutput(self):
+        """ Register the per-residue fit metrics table, if computed. """
+        tableFile = self._getExtraPath(FIT_TABLE)
+        if os.path.exists(tableFile) and \
+                not self.hasAttribute('outputFitMetrics'):
+            self._defineOutputs(outputFitMetrics=EMFile(filename=tableFile))
+
+    def _runInteractive(self, fnCmd, cwd):
+        """ Run the interactive session and wait until it is closed. When
+        streaming, each saved model and map is registered while it is open.
+        The step fails if ChimeraX exits with an error or exceeds the
+        limits.
+        """
+        from chimera import Plugin as chimera
+        settings = self._getLaunchSettings()
+        environ = chimera.getEnviron()
+        environ.update(getLaunchEnviron(settings))
+        process = SupervisedProcess([getChimeraXProgram(), fnCmd], cwd,
+                                    environ, log=self.info,
+                                    pidFile=os.path.join(cwd,
+                                                         CHIMERA_PID % 0))
+        self.info("ChimeraX session running with PID %d" % process.pid)
+
+        def register():
+            if self._registerOutputs(stableOnly=True):
+                self._store()
+
+        if self.streamOutputs:
+            process.wait(settings['wallTime'], settings['maxMemory'],
+                         onPoll=register,
+                         interval=self.streamInterval.get())
+        else:
+            process.wait(settings['wallTime'], settings['maxMemory'])
+
+    def _createBatchOutput(self):
+        """ Register the refined model of every job in a single set. """
+        outputSet = self._createSetOfPDBs()
+        for i in range(len(self.getRefinementJobs())):
+            fileName = self._getJobPath(i, HEADLESS_MODEL)
+            if os.path.exists(fileName):
+                outputSet.append(AtomStruct(filename=fileName))
+        self._defineOutputs(outputAtomStructs=outputSet)
+        for pointer in self.inputStructures:
+            self._defineSourceRelation(pointer, outputSet)
+
     # --------------------------- UTILS functions ----------------------------
+    def isHeadless(self):
+        return self.useSet or self.runMode.get() == MODE_HEADLESS
+
+    def getRefinementJobs(self):
+        """ List of (pdbFileName, volFileName) pairs to refine when several
+        structures are given. Structures without an associated volume are
+        paired with the input volume.
+        """
+        jobs = []
+        defaultVolFileName = self.inputVolume.get().getFileName()
+        for pointer in self.inputStructures:
+            obj = pointer.get()
+            structs = obj if isinstance(obj, SetOfAtomStructs) else [obj]
+            for struct in structs:
+                volFileName = struct.getVolume().getFileName() \
+                    if struct.hasVolume() else defaultVolFileName
+                jobs.append((struct.getFileName(), volFileName))
+        return jobs
+
+    def _checkChimeraX(self):
+        """ Errors and warnings about the ChimeraX installation. The probe
+        is run once per protocol object; if it fails, e.g. ChimeraX
+        crashes on start, that is only reported as a warning.
+        """
+        if getattr(self, '_chimeraXCheck', None) is None:
+            try:
+                self._chimeraXCheck = checkChimeraX(Plugin.getChimeraXProbe())
+            except Exception as e:
+                self._chimeraXCheck = (
+                    [], ["Could not check the ChimeraX installation: %s"
+                         % e])
+        return self._chimeraXCheck
+
+    def _getJobPath(self, jobIndex, *paths):
+        return self._getExtraPath('job_%03d' % jobIndex, *paths)
+
+    def _getRunDirs(self):
+        """ Directories where the headless ChimeraX runs were done. """
+        if self.useSet:
+            return [self._getJobPath(i)
+                    for i in range(len(self.getRefinementJobs()))]
+        if self.isSplit():
+            return [self._getExtraPath(REGIONS_DIR, 'region_%03d' % i)
+                    for i in range(len(self._readRegions()['regions']))]
+        if self.isStaged():
+            return [self._getStagePath('coarse'), self._getExtraPath()]
+        if self.isSweep():
+            return [self._getSweepPath(i)
+                    for i in range(len(self._readSweepVariants()))]
+        return [self._getExtraPath()]
+
+    def _getFitJobs(self):
+        """ Name, model and map of every refined model to validate, with
+        the map it was refined against.
+        """
+        pairs = []
+        if self.useSet:
+            for i, (_, volFileName) in enumerate(self.getRefinementJobs()):
+                if self.cropMap:
+                    volFileName = self._getCroppedMap(i)
+                pairs.append((self._getJobPath(i, HEADLESS_MODEL),
+                              volFileName))
+        elif self.isSweep():
+            volFileName = self._getCroppedMap(0) if self.cropMap \
+                else self.inputVolume.get().getFileName()
+            for i in range(len(self._readSweepVariants())):
+                pairs.append((self._getSweepPath(i, HEADLESS_MODEL),
+                              volFileName))
+        else:
+            volFileName = self._getCroppedMap(0) if self.cropMap \
+                else self.inputVolume.get().getFileName()
+            manifest = OutputManifest(self._getExtraPath())
+            for entry in manifest.update():
+                if entry['type'] == ATOMSTRUCT:
+                    pairs.append((manifest.getPath(entry), volFileName))
+        return [{'name': os.path.relpath(model, self._getExtraPath()),
+                 'model': os.path.abspath(model),
+                 'map': os.path.abspath(volFileName)}
+                for model, volFileName in pairs if os.path.exists(model)]
+
+    def _getFitSummary(self, maxModels=10):
+        """ Lines with the fit metrics of the best fitting models. """
+        fileName = self._getExtraPath(FIT_SUMMARY)
+        if not os.path.exists(fileName):
+            return []
+        with open(fileName) as f:
+            fits = json.load(f)
+        ranked = sorted(fits.items(), key=lambda item: -item[1]['density'])
+        lines = ["Fit metrics, best density fit first:"]
+        for name, fit in ranked[:maxModels]:
+            line = "%s: density %0.2f rms, clashscore %0.1f" \
+                   % (name, fit['density'], fit['clashscore'])
+            if fit['ramaOutliers'] is not None:
+                line += ", Ramachandran outliers %0.1f%%" % fit['ramaOutliers']
+            if fit['rotamerOutliers'] is not None:
+                line += ", rotamer outliers %0.1f%%" % fit['rotamerOutliers']
+            lines.append(line)
+        if len(ranked) > maxModels:
+            lines.append("%d more models in %s"
+                         % (len(ranked) - maxModels, FIT_TABLE))
+        return lines
+
+    def _getSweepSummary(self):
+        """ Size of the sweep and the combination with the best density
+        fit.
+        """
+        try:
+            lines = ["Sweep of %d combinations of map weight, temperature, "
+                     "hydrogens and ligand restraints"
+                     % len(self._getSweepVariants())]
+        except ValueError:
+            lines = ["Invalid sweep values, the map weights and "
+                     "temperatures must be lists of numbers"]
+        fileName = self._getExtraPath(SWEEP_TABLE)
+        if os.path.exists(fileName):
+            with open(fileName) as f:
+                rows = [row for row in csv.DictReader(f) if row['density']]
+            if rows:
+                best = max(rows, key=lambda row: float(row['density']))
+                lines.append("Best density fit: %s (map weight x%s, %s K, "
+                             "hydrogens %s, ligand restraints %s), see %s"
+                             % (best['name'], best['mapWeight'] or "1",
+                                best['temperature'] or "default",
+                                best['addH'], best['restrainLigands'],
+                                SWEEP_TABLE))
+        return lines
+
+    def _getResumeSource(self):
+        """ Most recent state of the model left by a previous launch as
+        (fileName, trajectoryDir), where trajectoryDir is given when the
+        coordinates must be restored from the last checkpoint of that
+        trajectory. None if there is nothing to resume from.
+        """
+        if not self.resume or self.useSet or self.isSplit() \
+                or self.isStaged() or self.isSweep() \
+                or not os.path.exists(self._getExtraPath()):
+            return None
+        candidates = []
+        trajectoryDir = self._getExtraPath(TRAJECTORY_DIR)
+        if getTrajectoryInfo(trajectoryDir):
+            candidates.append((os.path.getmtime(
+                os.path.join(trajectoryDir, TRAJECTORY_COORDS)),
+                getTopologyFile(trajectoryDir), trajectoryDir))
+        manifest = OutputManifest(self._getExtraPath())
+        for path in manifest.listFiles(ATOMSTRUCT):
+            candidates.append((os.path.getmtime(path), path, None))
+        if not candidates:
+            return None
+        _, fileName, trajectoryDir = max(candidates, key=lambda c: c[0])
+        return fileName, trajectoryDir
+
+    def _getNumberOfWorkers(self):
+        workers = getNumberOfWorkers(self.numberOfWorkers.get(),
+                                     self.workerMemory.get())
+        return max(1, min(workers, self.numberOfThreads.get()))
+
+    def _getLaunchSettings(self, numberOfWorkers=1):
+        """ Threads, OpenMM platform and cores of the ChimeraX processes
+        when numberOfWorkers of them share the threads of the protocol.
+        """
+        return getLaunchSettings(self.numberOfThreads.get(), numberOfWorkers,
+                                 OPENMM_PLATFORMS[self.openmmPlatform.get()],
+                                 bool(self.pinCpus),
+                                 wallTime=self.wallTimeLimit.get() * 3600,
+                                 maxMemory=self.memoryLimit.get())
+
+    def _runChimera(self, scriptFile, cwd, args=None):
+        """ Run one headless ChimeraX script with the launch settings of
+        the protocol, recorded in the run metrics.
+        """
+        settings = self._getLaunchSettings()
+        RunMetrics(self._getExtraPath()).addLaunch(settings)
+        runHeadlessChimera(scriptFile, cwd, args, settings, log=self.info)
+
+    def _runChimeraJobs(self, jobs, numberOfWorkers=None):
+        """ Run headless ChimeraX jobs concurrently, splitting the threads
+        of the protocol among the workers.
+        """
+        numberOfWorkers = numberOfWorkers or self._getNumberOfWorkers()
+        settings = self._getLaunchSettings(numberOfWorkers)
+        RunMetrics(self._getExtraPath()).addLaunch(settings)
+        runHeadlessChimeraJobs(jobs, numberOfWorkers, settings,
+                               log=self.info)
+
+    def usesPrepCache(self):
+        addH = bool(self.addH) or (self.isSweep() and bool(self.sweepAddH))
+        return addH and bool(self.usePrepCache)
+
+    def isSweep(self):
+        return (not self.useSet and self.isHeadless() and bool(self.sweep)
+                and not self.isSplit() and not self.isStaged())
+
+    def _getSweepValues(self, paramName):
+        """ Numbers listed in a sweep parameter, [None] if it is empty so
+        that ISOLDE keeps its own value.
+        """
+        values = self.getAttributeValue(paramName) or ''
+        return [float(v) for v in values.replace(',', ' ').split()] or [None]
+
+    def _getSweepVariants(self):
+        """ Every combination of the swept settings. """
+        addH = [True, False] if self.sweepAddH else [bool(self.addH)]
+        ligands = [True, False] if self.sweepLigands \
+            else [bool(self.restrainLigands)]
+        return [{'mapWeight': mapWeight, 'temperature': temperature,
+                 'addH': h, 'restrainLigands': restrain}
+                for mapWeight, temperature, h, restrain in itertools.product(
+                    self._getSweepValues('sweepMapWeights'),
+                    self._getSweepValues('sweepTemperatures'),
+                    addH, ligands)]
+
+    def _readSweepVariants(self):
+        """ Combinations written by the sweep step, empty before it. """
+        fileName = self._getExtraPath(SWEEP_FILE)
+        if not os.path.exists(fileName):
+            return []
+        with open(fileName) as f:
+            return json.load(f)
+
+    def _getSweepName(self, index):
+        return 'sweep_%03d' % index
+
+    def _getSweepPath(self, index, *paths):
+        return self._getExtraPath(SWEEP_DIR, self._getSweepName(index),
+                                  *paths)
+
+    def _getSweepFitName(self, index):
+        """ Name of a sweep model in the fit metrics. """
+        return os.path.relpath(self._getSweepPath(index, HEADLESS_MODEL),
+                               self._getExtraPath())
+
+    def _getInputPairs(self):
+        """ (pdbFileName, volFileName) of every input structure. """
+        if self.useSet:
+            return self.getRefinementJobs()
+        return [(self.pdbFileToBeRefined.get().getFileName(),
+                 self.inputVolume.get().getFileName())]
+
+    def _getInputModels(self):
+        return [pdbFileName for pdbFileName, _ in self._getInputPairs()]
+
+    def _getPreparedModel(self, index):
+        return self._getExtraPath(PREPARED_DIR, 'prepared_%03d.cif' % index)
+
+    def _getCroppedMap(self, index):
+        return self._getExtraPath(PREPARED_DIR, 'cropped_%03d.mrc' % index)
+
+    def usesReferenceRestraints(self):
+        return (not self.useSet and self.referenceModel.hasValue()
+                and bool(self.restrainDistances or self.restrainTorsions))
+
+    def isStaged(self):
+        return (not self.useSet and self.isHeadless() and bool(self.staged)
+                and not self.isSplit())
+
+    def _getCoarseMap(self):
+        return self._getExtraPath(PREPARED_DIR, 'coarse_000.mrc')
+
+    def _getStagePath(self, stage, *paths):
+        return self._getExtraPath(STAGES_DIR, stage, *paths)
+
+    def isSplit(self):
+        return (not self.useSet and self.isHeadless()
+                and self.splitMode.get() != SPLIT_NONE)
+
+    def _getRegionsFile(self):
+        return self._getExtraPath(REGIONS_DIR, REGIONS_FILE)
+
+    def _readRegions(self):
+        with open(self._getRegionsFile()) as f:
+            return json.load(f)
+
+    def getSetupCommands(self, pdbFileName=None, volFileName=None,
+                         prepared=False, checkpointDir=None,
+                         extraVolFileNames=(), addH=None,
+                         restrainLigands=None):
+        """ ChimeraX commands that open the volume and pdb, associate them
+        and prepare the model for the simulation. The protocol inputs are
+        opened unless other files are given, extraVolFileNames are
+        associated with the model too. addH and restrainLigands override
+        the protocol settings. Hydrogens are not added to
+        an already prepared model. If checkpoints are enabled they are
+        written in checkpointDir. A relaunched protocol resumes from its
+        latest checkpoint or saved model.
+        """
+        resumeDir = None
+        resumeSource = self._getResumeSource() if pdbFileName is None \
+            else None
+        if resumeSource:
+            # The saved model already went through the preparation
+            (pdbFileName, resumeDir), prepared = resumeSource, True
+        elif pdbFileName is None and self.usesPrepCache():
+            pdbFileName, prepared = self._getPreparedModel(0), True
+        if volFileName is None and self.cropMap:
+            volFileName = self._getCroppedMap(0)
+        pdbFileName = pdbFileName or \
+            self.pdbFileToBeRefined.get().getFileName()
+        volFileName = volFileName or self.inputVolume.get().getFileName()
+        commands = ["open %s" % os.path.abspath(pdbFileName),
+                    "open %s" % os.path.abspath(volFileName)]
+        commands += ["open %s" % os.path.abspath(extraVolFileName)
+                     for extraVolFileName in extraVolFileNames]
+        if resumeDir:
+            commands.append("runscript %s %s" % (getScript(RESTORE_SCRIPT),
+                                                 os.path.abspath(resumeDir)))
+        mapSpec = "#2-%d" % (2 + len(extraVolFileNames)) \
+            if extraVolFileNames else "#2"
+        commands += ["clipper assoc %s to #1" % mapSpec,
+                     "isolde start"]
+        addH = self.addH if addH is None else addH
+        restrainLigands = self.restrainLigands if restrainLigands is None \
+            else restrainLigands
+        if addH and not prepared:
+            commands.append("addh")
+        if self.hideHC:
+            commands.append("hide HC")
+        if restrainLigands:
+            commands.append("isolde restrain ligands #1")
+        if self.usesReferenceRestraints():
+            commands.append("runscript %s load %s"
+                            % (getScript(RESTRAINTS_SCRIPT), os.path.abspath(
+                                self._getExtraPath(RESTRAINTS_FILE))))
+        if self.checkpoint and checkpointDir:
+            commands.append("runscript %s %s %d"
+                            % (getScript(CHECKPOINT_SCRIPT),
+                               os.path.abspath(checkpointDir),
+                               self.checkpointInterval.get()))
+        return commands
+
     def writeChimeraScript(self):
         """ Builds script file to open the volume and pdb and associate them as
-        well as set some further parameters for the simulation.
-        """
-        f = open(self._getExtraPath('chimera_script.cxc'), "w")
-        f.write("open %s \n" % os.path.abspath(self.pdbFileToBeRefined.get().getFileName()))
-        f.write("open %s\n" % os.path.abspath(self.inputVolume.get().getFileName()))
-        f.write("clipper assoc #2 to #1\n")
-        f.write("isolde start\n")
-        if self.addH:
-            f.write("addh\n")
-        if self.hideHC:
-            f.write("hide HC\n")
-        if self.restrainLigands:
-            f.write("isolde restrain ligands #1\n")
+        well as set some further parameters for the simulation. In headless
+        mode the script also runs the simulation and saves the model.
+        Returns the script file name.
+        """
+        if self.isHeadless():
+            return self._writeHeadlessScript()
+
+        fnCmd = self._getExtraPath(CHIMERA_SCRIPT)
+        f = open(fnCmd, "w")
+        checkpointDir = self._getExtraPath(TRAJECTORY_DIR)
+        for command in self.getSetupCommands(checkpointDir=checkpointDir):
+            f.write("%s\n" % command)
+        # The headless script sets the platform in Python
+        platform = OPENMM_PLATFORMS[self.openmmPlatform.get()]
+        if platform:
+            f.write("runscript %s %s\n" % (getScript(PLATFORM_SCRIPT),
+                                           platform))
+        f.close()
+        return fnCmd
+
+    def _writeHeadlessScript(self, outputDir=None, pdbFileName=None,
+                             volFileName=None, simSpec='#1', prepared=False,
+                             simSteps=None, extraVolFileNames=(),
+                             variant=None):
+        """ Python version of the ChimeraX script, to be run with
+        --nogui --offscreen. The simulation is advanced in chunks of
+        frames until the number of timesteps is reached or, if requested,
+        until the RMS shift between chunks is below the tolerance.
+        The script and the refined model are written in outputDir, the
+        extra dir by default. When simSpec is a part of the model only
+        those atoms are simulated, surrounded by a fixed shell, and saved.
+        simSteps overrides the number of timesteps of the protocol and a
+        sweep variant its map weight, temperature, hydrogens and ligand
+        restraints.
+        """
+        region = simSpec != '#1'
+        outputDir = outputDir or self._getExtraPath()
+        simSteps = simSteps or self.simSteps.get()
+        convergence = self.stopCriterion.get() == STOP_CONVERGENCE
+        checkSteps = self.checkSteps.get() if convergence else simSteps
+
+        fnCmd = os.path.join(outputDir, HEADLESS_SCRIPT)
+        f = open(fnCmd, "w")
+        f.write("import json\n")
+        f.write("import math\n")
+        f.write("import resource\n")
+        f.write("import sys\n")
+        f.write("import time\n")
+        f.write("from chimerax.core.commands import run\n")
+        f.write("from chimerax.map import Volume\n")
+        # Wall time of every phase, written with the run results
+        f.write("metrics = {'phases': {}}\n")
+        f.write("def timed(phase, command):\n")
+        f.write("    start = time.time()\n")
+        f.write("    run(session, command)\n")
+        f.write("    metrics['phases'][phase] = "
+                "metrics['phases'].get(phase, 0) + time.time() - start\n")
+        checkpointDir = os.path.join(outputDir, TRAJECTORY_DIR)
+        variant = variant or {}
+        for command in self.getSetupCommands(
+                pdbFileName, volFileName, prepared=prepared,
+                checkpointDir=checkpointDir,
+                extraVolFileNames=extraVolFileNames,
+                addH=variant.get('addH'),
+                restrainLigands=variant.get('restrainLigands')):
+            phase = 'load' if command.startswith('open ') else 'setup'
+            f.write("timed(%r, %r)\n" % (phase, command))
+        platform = OPENMM_PLATFORMS[self.openmmPlatform.get()]
+        if platform:
+            f.write("session.isolde.sim_params.platform = %r\n" % platform)
+        f.write("model = session.models.list(model_id=(1,))[0]\n")
+        f.write("volumes = session.models.list(type=Volume)\n")
+        f.write("if volumes:\n")
+        f.write("    metrics['mapSize'] = [int(n) for n in "
+                "volumes[0].data.size]\n")
+        if variant.get('temperature') is not None:
+            f.write("session.isolde.sim_params.temperature = %f\n"
+                    % variant['temperature'])
+        if variant.get('mapWeight') is not None:
+            # Scale the coupling of the model to every associated map
+            f.write("from chimerax.isolde.session_extensions import "
+                    "get_mdff_mgr\n")
+            f.write("for volume in volumes:\n")
+            f.write("    mdff = get_mdff_mgr(model, volume)\n")
+            f.write("    if mdff is not None:\n")
+            f.write("        mdff.global_k *= %f\n" % variant['mapWeight'])
+        if region:
+            # Only the region is mobile, its surroundings are held fixed
+            f.write("from chimerax.atomic import selected_atoms\n")
+            f.write("session.isolde.sim_params.soft_shell_cutoff_distance "
+                    "= 0\n")
+            f.write("session.isolde.sim_params.hard_shell_cutoff_distance "
+                    "= %f\n" % self.shellRadius.get())
+            f.write("run(session, 'select %s')\n" % simSpec)
+            f.write("atoms = selected_atoms(session)\n")
+        else:
+            f.write("atoms = model.atoms\n")
+        f.write("stepsPerFrame = getattr(session.isolde.sim_params, "
+                "'sim_steps_per_gui_update', %d)\n"
+                % DEFAULT_STEPS_PER_FRAME)
+        f.write("maxFrames = max(1, int(math.ceil(%d / stepsPerFrame)))\n"
+                % simSteps)
+        f.write("checkFrames = max(1, int(math.ceil(%d / stepsPerFrame)))\n"
+                % checkSteps)
+        f.write("start = time.time()\n")
+        f.write("run(session, 'isolde sim start %s')\n" % simSpec)
+        f.write("frames = 0\n")
+        f.write("previous = atoms.coords.copy()\n")
+        f.write("while frames < maxFrames:\n")
+        f.write("    n = min(checkFrames, maxFrames - frames)\n")
+        f.write("    run(session, 'wait %d' % n)\n")
+        f.write("    frames += n\n")
+        f.write("    coords = atoms.coords\n")
+        f.write("    shift = math.sqrt(((coords - previous) ** 2)"
+                ".sum(axis=1).mean())\n")
+        f.write("    session.logger.info('ISOLDE: %d timesteps, RMS shift "
+                "%.4f A' % (frames * stepsPerFrame, shift))\n")
+        if convergence:
+            f.write("    if shift < %f:\n" % self.convergenceTol.get())
+            f.write("        break\n")
+        f.write("    previous = coords.copy()\n")
+        f.write("run(session, 'isolde sim stop')\n")
+        f.write("metrics['phases']['simulation'] = time.time() - start\n")
+        saveOptions = ""
+        if region:
+            f.write("run(session, 'select %s')\n" % simSpec)
+            saveOptions = " selectedOnly true"
+        f.write("timed('save', 'save %s models #1%s')\n"
+                % (os.path.abspath(os.path.join(outputDir, HEADLESS_MODEL)),
+                   saveOptions))
+        f.write("with open(%r, 'a') as manifest:\n"
+                % os.path.abspath(os.path.join(outputDir, MANIFEST_FILE)))
+        f.write("    manifest.write(%r)\n"
+                % (json.dumps(manifestEntry(HEADLESS_MODEL, ATOMSTRUCT))
+                   + "\n"))
+        f.write("try:\n")
+        f.write("    from openmm import unit\n")
+        f.write("    timestep = session.isolde.sim_params.timestep"
+                ".value_in_unit(unit.picosecond)\n")
+        f.write("except Exception:\n")
+        f.write("    timestep = None\n")
+        f.write("metrics.update(steps=frames * stepsPerFrame, "
+                "timestep=timestep, atoms=len(model.atoms), "
+                "simulatedAtoms=len(atoms), peakRss=resource.getrusage("
+                "resource.RUSAGE_SELF).ru_maxrss / (1024.0 ** 2 "
+                "if sys.platform == 'darwin' else 1024.0))\n")
+        f.write("with open(%r, 'w') as f:\n"
+                % os.path.abspath(os.path.join(outputDir, CHIMERA_METRICS)))
+        f.write("    json.dump(metrics, f, indent=1)\n")
         f.close()
+        return fnCmd
 
     # --------------------------- INFO functions ----------------------------
+    def _validate(self):
+        """ Check that ChimeraX and a suitable ISOLDE are installed before
+        starting any session.
+        """
+        errors = []
+        if (not self.useSet and self.isHeadless() and self.staged
+                and self.isSplit()):
+            errors.append("Coarse-to-fine refinement can not be combined "
+                          "with splitting the model.")
+        if not self.useSet and self.isHeadless() and self.sweep:
+            if self.isSplit() or self.isStaged():
+                errors.append("A sweep can not be combined with splitting "
+                              "the model or a coarse-to-fine refinement.")
+            for paramName in ['sweepMapWeights', 'sweepTemperatures']:
+                try:
+                    self._getSweepValues(paramName)
+                except ValueError:
+                    errors.append("%s must be a list of numbers."
+                                  % self.getParam(paramName).label)
+        errors += self._checkChimeraX()[0]
+        return errors
+
+    def _warnings(self):
+        return self._checkChimeraX()[1]
+
     def _methods(self):
         methodsMsgs = []
         if self.getOutputsSize() >= 1:
-            directory = self._getExtraPath()
-            for filename in sorted(os.listdir(directory)):
-                if filename.endswith(".pdb") or filename.endswith(".cif"):
-                    methodsMsgs.append("PDB: %s was saved after simulation" % filename)
-                if filename.endswith(".mrc"):
-                    methodsMsgs.append("Map: %s was saved after simulation" % filename)
+            for entry in OutputManifest(self._getExtraPath()).entries():
+                if entry['type'] == ATOMSTRUCT:
+                    methodsMsgs.append("PDB: %s was saved after simulation"
+                                       % entry['filename'])
+                else:
+                    methodsMsgs.append("Map: %s was saved after simulation"
+                                       % entry['filename'])
+            if self.useSet and hasattr(self, 'outputAtomStructs'):
+                methodsMsgs.append("%d structures were refined in headless "
+                                   "mode" % self.outputAtomStructs.getSize())
+            elif self.isSweep() and hasattr(self, 'outputAtomStructs'):
+                methodsMsgs.append("The structure was refined in headless "
+                                   "mode with %d combinations of settings"
+                                   % self.outputAtomStructs.getSize())
         else:
             methodsMsgs.append("Simulation running")
         return methodsMsgs
@@ -221,16 +1535,59 @@ class ProtIsolde(EMProtocol):
         summary = []
         summary.append("Input Volume provided: %s"
                        % self.inputVolume.get().getFileName())
-        summary.append("Input PDB provided: %s"
-                       % self.pdbFileToBeRefined.get().getFileName())
+        if self.useSet:
+            summary.append("Input structures provided: %d"
+                           % len(self.getRefinementJobs()))
+        else:
+            summary.append("Input PDB provided: %s"
+                           % self.pdbFileToBeRefined.get().getFileName())
+        if self.cropMap:
+            summary.append("Map boxed around the model with %0.1f A padding"
+                           % self.cropPadding.get())
+        if self.usesReferenceRestraints():
+            summary.append("Restrained to reference structure: %s"
+                           % self.referenceModel.get().getFileName())
+        if self.isHeadless():
+            summary.append("Headless run of %d timesteps%s"
+                           % (self.simSteps.get(),
+                              " (or until convergence)"
+                              if self.stopCriterion.get() == STOP_CONVERGENCE
+                              else ""))
+            if self.isSplit():
+                summary.append("Simulated %s in parallel and merged"
+                               % ("per chain"
+                                  if self.splitMode.get() == SPLIT_CHAINS
+                                  else "in spatial regions"))
+            if self.isStaged():
+                summary.append("Coarse-to-fine: %d timesteps against the "
+                               "map at %0.1f A, binned %dx, then %d map(s) "
+                               "at full resolution"
+                               % (self.coarseSteps.get(),
+                                  self.coarseResolution.get(),
+                                  self.coarseBinning.get(),
+                                  1 + len(self.stageMaps)))
+        if self.isSweep():
+            summary += self._getSweepSummary()
+        summary += RunMetrics(self._getExtraPath()).getSummary()
+        summary += self._getFitSummary()
+        trajectoryInfo = getTrajectoryInfo(self._getExtraPath(TRAJECTORY_DIR))
+        if trajectoryInfo:
+            summary.append("Trajectory: %d frames of %d atoms, every %d "
+                           "timesteps" % (trajectoryInfo['frames'],
+                                          trajectoryInfo['atoms'],
+                                          trajectoryInfo['timestepsPerFrame']))
         if self.getOutputsSize() > 0:
-            directory = self._getExtraPath()
-            summary.append("Produced files:")
-            for filename in sorted(os.listdir(directory)):
-                if filename.endswith(".pdb") or filename.endswith(".cif"):
-                    summary.append("PDB: %s" % filename)
-                if filename.endswith(".mrc"):
-                    summary.append("Map: %s" % filename)
+            if hasattr(self, 'outputAtomStructs'):
+                summary.append("Refined structures: %d"
+                               % self.outputAtomStructs.getSize())
+            entries = OutputManifest(self._getExtraPath()).entries()
+            if entries:
+                summary.append("Produced files:")
+            for entry in entries:
+                if entry['type'] == ATOMSTRUCT:
+                    summary.append("PDB: %s" % entry['filename'])
+                else:
+                    summary.append("Map: %s" % entry['filename'])
         else:
             summary.append(Message.TEXT_NO_OUTPUT_FILES)
         return summary
@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+ChimeraX script used by the ISOLDE protocol to checkpoint the coordinates
+of model #1 while it is simulated, interactively or headless:
+
+    runscript isolde_checkpoint.py directory intervalTimesteps
+
+The model is saved once as topology.cif and, every intervalTimesteps,
+the coordinates are appended to coords.f32 as a float32 frame of shape
+(atoms, 3) if they changed. trajectory.json describes the frames so the
+file can be memory-mapped. Frames are only written while the number of
+atoms matches the topology. A previous trajectory with the same number of
+atoms, e.g. from a resumed session, is extended instead of replaced.
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from chimerax.core.commands import run
+from chimerax.core.triggerset import DEREGISTER
+
+TOPOLOGY = 'topology.cif'
+COORDS = 'coords.f32'
+INFO = 'trajectory.json'
+
+
+def writeInfo(directory, info):
+    tmpFile = os.path.join(directory, INFO + '.tmp')
+    with open(tmpFile, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmpFile, os.path.join(directory, INFO))
+
+
+def startCheckpoints(session, directory, interval):
+    model = session.models.list(model_id=(1,))[0]
+    os.makedirs(directory, exist_ok=True)
+    stepsPerFrame = getattr(session.isolde.sim_params,
+                            'sim_steps_per_gui_update', 50)
+    everyFrames = max(1, interval // stepsPerFrame)
+
+    coordsFile = os.path.join(directory, COORDS)
+    infoFile = os.path.join(directory, INFO)
+    info = None
+    if os.path.exists(infoFile):
+        with open(infoFile) as f:
+            info = json.load(f)
+        if info['atoms'] != len(model.atoms):
+            info = None
+    if info is not None:
+        # A crash between appending a frame and writing the info leaves
+        # extra or partial frames, cut them before appending new ones
+        frameBytes = info['atoms'] * 3 * np.dtype(np.float32).itemsize
+        size = os.path.getsize(coordsFile) \
+            if os.path.exists(coordsFile) else 0
+        info['frames'] = min(info['frames'], size // frameBytes)
+        with open(coordsFile, 'ab') as f:
+            f.truncate(info['frames'] * frameBytes)
+    if info is None:
+        run(session, 'save %s models #1'
+            % os.path.join(directory, TOPOLOGY))
+        open(coordsFile, 'wb').close()
+        info = {'atoms': len(model.atoms), 'frames': 0, 'dtype': 'float32',
+                'topology': TOPOLOGY, 'coords': COORDS}
+    info['timestepsPerFrame'] = everyFrames * stepsPerFrame
+    writeInfo(directory, info)
+    state = {'frame': 0, 'last': model.atoms.coords.astype(np.float32)}
+
+    def checkpoint(trigger, data):
+        if model.deleted:
+            return DEREGISTER
+        state['frame'] += 1
+        if state['frame'] % everyFrames:
+            return
+        atoms = model.atoms
+        if len(atoms) != info['atoms']:
+            return
+        coords = atoms.coords.astype(np.float32)
+        if np.array_equal(coords, state['last']):
+            return
+        with open(coordsFile, 'ab') as f:
+            f.write(coords.tobytes())
+        state['last'] = coords
+        info['frames'] += 1
+        writeInfo(directory, info)
+
+    session.triggers.add_handler('new frame', checkpoint)
+
+
+# ChimeraX provides the session global when running the script
+startCheckpoints(session, sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,101 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+ChimeraX script used by the ISOLDE protocol to box a map around a model
+before the simulation, optionally resampling it to a new voxel size:
+
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_crop.py model.cif map.mrc output.mrc padding [voxelSize]"
+
+The batch form boxes the map around each model of a JSON list of
+{"model": ..., "output": ...} items, reading the map only once:
+
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_crop.py batch crops.json map.mrc padding [voxelSize]"
+
+The origin (A) and voxel size of the saved map are written next to it in
+output.json so the header can be checked from Scipion.
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from chimerax.core.commands import run
+
+
+def crop(session, model, volume, outputFile, padding, voxelSize=0):
+    """ Save the box of volume around the model atoms plus padding (A). """
+    xyz = model.atoms.scene_coords
+    data = volume.data
+    ijkMin = np.floor(data.xyz_to_ijk(xyz.min(axis=0) - padding)).astype(int)
+    ijkMax = np.ceil(data.xyz_to_ijk(xyz.max(axis=0) + padding)).astype(int)
+    ijkMin = np.clip(ijkMin, 0, np.array(data.size) - 1)
+    ijkMax = np.clip(ijkMax, 0, np.array(data.size) - 1)
+    run(session, 'volume copy #%s subregion %d,%d,%d,%d,%d,%d modelId 3'
+        % ((volume.id_string,) + tuple(ijkMin) + tuple(ijkMax)))
+    result = session.models.list(model_id=(3,))[0]
+
+    if voxelSize > 0:
+        origin = np.array(result.data.origin)
+        extent = (ijkMax - ijkMin) * np.array(data.step)
+        size = np.ceil(extent / voxelSize).astype(int) + 1
+        run(session, 'volume new grid size %d,%d,%d gridSpacing %f '
+                     'origin %f,%f,%f modelId 4'
+            % (tuple(size) + (voxelSize,) + tuple(origin)))
+        run(session, 'volume resample #3 onGrid #4 modelId 5')
+        result = session.models.list(model_id=(5,))[0]
+
+    run(session, 'save %s models #%s' % (outputFile, result.id_string))
+    with open(os.path.splitext(outputFile)[0] + '.json', 'w') as f:
+        json.dump({'origin': [float(x) for x in result.data.origin],
+                   'voxelSize': [float(x) for x in result.data.step],
+                   'size': [int(x) for x in result.data.size]}, f)
+    run(session, 'close #3-5')
+
+
+# ChimeraX provides the session global when running the script
+if sys.argv[1] == 'batch':
+    cropsFile, mapFile, padding = sys.argv[2:5]
+    voxelSize = float(sys.argv[5]) if len(sys.argv) > 5 else 0
+    with open(cropsFile) as f:
+        crops = json.load(f)
+    volume = run(session, 'open %s' % mapFile)[0]
+    for item in crops:
+        model = run(session, 'open %s' % item['model'])[0]
+        crop(session, model, volume, item['output'], float(padding),
+             voxelSize)
+        session.models.close([model])
+else:
+    modelFile, mapFile, outputFile, padding = sys.argv[1:5]
+    voxelSize = float(sys.argv[5]) if len(sys.argv) > 5 else 0
+    model = run(session, 'open %s' % modelFile)[0]
+    volume = run(session, 'open %s' % mapFile)[0]
+    crop(session, model, volume, outputFile, float(padding), voxelSize)
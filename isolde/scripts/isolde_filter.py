@@ -0,0 +1,66 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+ChimeraX script used by the ISOLDE protocol to make the coarse map of a
+staged refinement, binned and low-pass filtered with a Gaussian:
+
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_filter.py map.mrc output.mrc resolution binSize"
+
+A resolution or bin size of 0 skips that operation. As for the cropped
+maps, the origin (A) and voxel size are written in output.json.
+"""
+
+import json
+import os
+import sys
+
+from chimerax.core.commands import run
+
+# Gaussian width, in A, that blurs the map to a given resolution, as molmap
+SIGMA_FACTOR = 0.225
+
+mapFile, outputFile = sys.argv[1:3]
+resolution = float(sys.argv[3])
+binSize = int(sys.argv[4])
+
+# ChimeraX provides the session global when running the script
+result = run(session, 'open %s' % mapFile)[0]
+if binSize > 1:
+    run(session, 'volume bin #%s binSize %d modelId 2'
+        % (result.id_string, binSize))
+    result = session.models.list(model_id=(2,))[0]
+if resolution > 0:
+    run(session, 'volume gaussian #%s sDev %f modelId 3'
+        % (result.id_string, SIGMA_FACTOR * resolution))
+    result = session.models.list(model_id=(3,))[0]
+
+run(session, 'save %s models #%s' % (outputFile, result.id_string))
+with open(os.path.splitext(outputFile)[0] + '.json', 'w') as f:
+    json.dump({'origin': [float(x) for x in result.data.origin],
+               'voxelSize': [float(x) for x in result.data.step],
+               'size': [int(x) for x in result.data.size]}, f)
@@ -0,0 +1,65 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+ChimeraX script used by the plugin installer. ISOLDE is installed from
+the toolshed only if it is missing or older than the given version:
+
+    ChimeraX --nogui --exit --script "isolde_install.py 1.0"
+"""
+
+import sys
+
+from chimerax.core.commands import run
+
+ISOLDE_BUNDLE = 'ChimeraX-ISOLDE'
+
+
+def versionTuple(version):
+    numbers = []
+    for part in str(version).split('.'):
+        digits = ''
+        for char in part:
+            if not char.isdigit():
+                break
+            digits += char
+        if not digits:
+            break
+        numbers.append(int(digits))
+    return tuple(numbers)
+
+
+minVersion = sys.argv[1]
+installed = None
+# ChimeraX provides the session global when running the script
+for bundle in session.toolshed.bundle_info(session.logger, installed=True,
+                                           available=False):
+    if bundle.name == ISOLDE_BUNDLE:
+        installed = bundle.version
+if installed and versionTuple(installed) >= versionTuple(minVersion):
+    session.logger.info("ISOLDE %s is already installed" % installed)
+else:
+    run(session, 'toolshed install isolde')
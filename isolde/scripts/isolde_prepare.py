@@ -0,0 +1,44 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+ChimeraX script used by the ISOLDE protocol to prepare an input model
+before the simulation:
+
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_prepare.py input.cif output.cif"
+"""
+
+import sys
+
+from chimerax.core.commands import run
+
+inputFile, outputFile = sys.argv[1:3]
+# ChimeraX provides the session global when running the script
+model = run(session, 'open %s' % inputFile)[0]
+run(session, 'addh #%s' % model.id_string)
+run(session, 'save %s models #%s' % (outputFile, model.id_string))
@@ -0,0 +1,159 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+ChimeraX script used by the ISOLDE protocol to split a large model in
+regions and to merge the refined regions back. It runs inside ChimeraX:
+
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_regions.py plan model.cif regions.json chain|spatial size \
+        shell [addh]"
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_regions.py merge regions.json output.cif"
+
+The plan saves the (optionally hydrogenated) model next to regions.json so
+that every region and the merge work on exactly the same atoms. It also
+saves, for every region, a model with only the residues of the region and
+of the shell around it, so that a region job does not load the whole
+structure.
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from chimerax.core.commands import run
+
+PREPARED_MODEL = 'prepared.cif'
+
+
+def residueSpec(residues):
+    """ Atom spec for a list of residues, e.g. /A:1-5,9/B:3 """
+    byChain = {}
+    for r in residues:
+        byChain.setdefault(r.chain_id, []).append(r)
+    spec = ''
+    for chainId, chainResidues in byChain.items():
+        items = []
+        start = end = None
+        for r in sorted(chainResidues, key=lambda r: (r.number,
+                                                      r.insertion_code)):
+            if r.insertion_code:
+                items.append('%d%s' % (r.number, r.insertion_code))
+                start = end = None
+            elif end is not None and r.number == end + 1:
+                end = r.number
+                items[-1] = '%d-%d' % (start, end) if start != end \
+                    else '%d' % start
+            else:
+                start = end = r.number
+                items.append('%d' % start)
+        spec += '/%s:%s' % (chainId, ','.join(items))
+    return spec
+
+
+def chainRegions(model):
+    return [{'name': 'chain_%s' % chainId, 'spec': '/%s' % chainId}
+            for chainId in sorted(set(model.residues.chain_ids))]
+
+
+def spatialRegions(model, size):
+    """ Group residues in cubic cells of the given edge (A) according to
+    the centre of their atoms.
+    """
+    residues = model.residues
+    centres = np.array([r.atoms.coords.mean(axis=0) for r in residues])
+    cells = np.floor((centres - centres.min(axis=0)) / size).astype(int)
+    groups = {}
+    for residue, cell in zip(residues, map(tuple, cells)):
+        groups.setdefault(cell, []).append(residue)
+    return [{'name': 'region_%d_%d_%d' % cell, 'spec': residueSpec(group)}
+            for cell, group in sorted(groups.items())]
+
+
+def plan(session, modelFile, regionsFile, mode, size, shell, addh=False):
+    model = run(session, 'open %s' % modelFile)[0]
+    if addh:
+        run(session, 'addh #%s' % model.id_string)
+    regionsDir = os.path.dirname(os.path.abspath(regionsFile))
+    prepared = os.path.join(regionsDir, PREPARED_MODEL)
+    run(session, 'save %s models #%s' % (prepared, model.id_string))
+    if mode == 'chain':
+        regions = chainRegions(model)
+    else:
+        regions = spatialRegions(model, float(size))
+    for region in regions:
+        # Whole residues with any atom within the shell of the region
+        region['model'] = os.path.join(regionsDir, '%s.cif' % region['name'])
+        run(session, 'select #%s%s :<%f'
+            % (model.id_string, region['spec'], float(shell)))
+        run(session, 'save %s models #%s selectedOnly true'
+            % (region['model'], model.id_string))
+    run(session, 'select clear')
+    with open(regionsFile, 'w') as f:
+        json.dump({'prepared': prepared, 'regions': regions}, f, indent=1)
+    session.logger.info('%d regions written to %s'
+                        % (len(regions), regionsFile))
+
+
+def atomKey(atom):
+    r = atom.residue
+    return r.chain_id, r.number, r.insertion_code, atom.name, atom.alt_loc
+
+
+def merge(session, regionsFile, outputFile):
+    """ Copy the coordinates of every refined region onto the prepared
+    model and save it.
+    """
+    with open(regionsFile) as f:
+        plan = json.load(f)
+    base = run(session, 'open %s' % plan['prepared'])[0]
+    atoms = base.atoms
+    index = {atomKey(a): i for i, a in enumerate(atoms)}
+    coords = atoms.coords
+    for region in plan['regions']:
+        refined = run(session, 'open %s' % region['output'])[0]
+        for atom, xyz in zip(refined.atoms, refined.atoms.coords):
+            i = index.get(atomKey(atom))
+            if i is not None:
+                coords[i] = xyz
+        session.models.close([refined])
+    atoms.coords = coords
+    run(session, 'save %s models #%s' % (outputFile, base.id_string))
+
+
+# ChimeraX provides the session global when running the script
+action, args = sys.argv[1], sys.argv[2:]
+if action == 'plan':
+    plan(session, args[0], args[1], args[2], args[3], args[4],
+         addh=len(args) > 5 and args[5] == 'addh')
+elif action == 'merge':
+    merge(session, args[0], args[1])
+else:
+    raise ValueError("Unknown action %s" % action)
@@ -0,0 +1,55 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+ChimeraX script used by the ISOLDE protocol to resume a simulation from
+its last checkpoint. Model #1 must be the topology of the trajectory:
+
+    runscript isolde_restore.py trajectoryDirectory
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+directory = sys.argv[1]
+with open(os.path.join(directory, 'trajectory.json')) as f:
+    info = json.load(f)
+
+# ChimeraX provides the session global when running the script
+model = session.models.list(model_id=(1,))[0]
+if info['frames'] > 0 and info['atoms'] == len(model.atoms):
+    frames = np.memmap(os.path.join(directory, info['coords']),
+                       dtype=np.float32, mode='r',
+                       shape=(info['frames'], info['atoms'], 3))
+    model.atoms.coords = np.array(frames[-1], dtype=np.float64)
+    session.logger.info("Resumed from checkpoint frame %d" % info['frames'])
+else:
+    session.logger.warning("Checkpoint in %s does not match model #1, "
+                           "starting from the saved topology" % directory)
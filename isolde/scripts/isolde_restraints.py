@@ -0,0 +1,162 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+ChimeraX script used by the ISOLDE protocol to restrain a model to a
+reference structure. The restraints are generated once and saved, with
+their atoms identified by chain, residue and name, so that any later
+session on the same model loads them instead of regenerating them:
+
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_restraints.py generate model.cif reference.cif out.json
+         distances torsions distanceCutoff angleRange"
+
+    runscript isolde_restraints.py load restraints.json
+
+distances and torsions are 1 or 0. When loading, model #1 is restrained.
+"""
+
+import json
+import sys
+
+from chimerax.atomic import Atoms, Residues
+from chimerax.core.commands import run
+from chimerax.isolde import session_extensions as sx
+
+DISTANCE_FIELDS = ['targets', 'tolerances', 'kappas', 'cs', 'alphas']
+TORSION_FIELDS = ['targets', 'spring_constants', 'kappas', 'alphas']
+
+
+def residueKey(residue):
+    return [residue.chain_id, residue.number, residue.insertion_code]
+
+
+def atomKey(atom):
+    return residueKey(atom.residue) + [atom.name]
+
+
+def saveDistances(model):
+    restraints = sx.get_adaptive_distance_restraint_mgr(
+        model).get_all_restraints()
+    restraints = restraints[restraints.enableds]
+    atoms1, atoms2 = restraints.atoms
+    saved = {'atoms': [[atomKey(a1), atomKey(a2)]
+                       for a1, a2 in zip(atoms1, atoms2)]}
+    for field in DISTANCE_FIELDS:
+        saved[field] = getattr(restraints, field).tolist()
+    return saved
+
+
+def saveTorsions(model):
+    restraints = sx.get_adaptive_dihedral_restraint_mgr(
+        model).get_all_restraints()
+    restraints = restraints[restraints.enableds]
+    dihedrals = restraints.dihedrals
+    saved = {'residues': [residueKey(r) for r in dihedrals.residues],
+             'names': list(dihedrals.names)}
+    for field in TORSION_FIELDS:
+        saved[field] = getattr(restraints, field).tolist()
+    return saved
+
+
+def generate(session, modelFile, referenceFile, outputFile, distances,
+             torsions, distanceCutoff, angleRange):
+    model = run(session, 'open %s' % modelFile)[0]
+    reference = run(session, 'open %s' % referenceFile)[0]
+    run(session, 'isolde start')
+    saved = {}
+    if distances:
+        run(session, 'isolde restrain distances #%s templateAtoms #%s '
+                     'distanceCutoff %f'
+            % (model.id_string, reference.id_string, distanceCutoff))
+        saved['distances'] = saveDistances(model)
+    if torsions:
+        run(session, 'isolde restrain torsions #%s templateResidues #%s '
+                     'angleRange %f'
+            % (model.id_string, reference.id_string, angleRange))
+        saved['torsions'] = saveTorsions(model)
+    with open(outputFile, 'w') as f:
+        json.dump(saved, f)
+
+
+def load(session, restraintsFile):
+    """ Restrain model #1. Restraints on atoms missing in the model are
+    skipped.
+    """
+    with open(restraintsFile) as f:
+        saved = json.load(f)
+    model = session.models.list(model_id=(1,))[0]
+    atomIndex = {tuple(atomKey(a)): a for a in model.atoms}
+    residueIndex = {tuple(residueKey(r)): r for r in model.residues}
+
+    if 'distances' in saved:
+        distances = saved['distances']
+        found = [i for i, (k1, k2) in enumerate(distances['atoms'])
+                 if tuple(k1) in atomIndex and tuple(k2) in atomIndex]
+        atoms1 = Atoms([atomIndex[tuple(distances['atoms'][i][0])]
+                        for i in found])
+        atoms2 = Atoms([atomIndex[tuple(distances['atoms'][i][1])]
+                        for i in found])
+        restraints = sx.get_adaptive_distance_restraint_mgr(
+            model).add_restraints(atoms1, atoms2)
+        for field in DISTANCE_FIELDS:
+            setattr(restraints, field, [distances[field][i] for i in found])
+        restraints.enableds = True
+        session.logger.info("Loaded %d distance restraints" % len(found))
+
+    if 'torsions' in saved:
+        torsions = saved['torsions']
+        manager = sx.get_adaptive_dihedral_restraint_mgr(model)
+        loaded = 0
+        for name in sorted(set(torsions['names'])):
+            found = [i for i, (key, n) in enumerate(zip(torsions['residues'],
+                                                        torsions['names']))
+                     if n == name and tuple(key) in residueIndex]
+            residues = Residues([residueIndex[tuple(torsions['residues'][i])]
+                                 for i in found])
+            restraints = manager.add_restraints_by_residues_and_name(
+                residues, name)
+            # Residues without this dihedral get no restraint
+            keys = [tuple(residueKey(r))
+                    for r in restraints.dihedrals.residues]
+            position = {tuple(torsions['residues'][i]): i for i in found}
+            for field in TORSION_FIELDS:
+                setattr(restraints, field,
+                        [torsions[field][position[k]] for k in keys])
+            restraints.enableds = True
+            loaded += len(restraints)
+        session.logger.info("Loaded %d torsion restraints" % loaded)
+
+
+# ChimeraX provides the session global when running the script
+action, args = sys.argv[1], sys.argv[2:]
+if action == 'generate':
+    generate(session, args[0], args[1], args[2], args[3] == '1',
+             args[4] == '1', float(args[5]), float(args[6]))
+elif action == 'load':
+    load(session, args[0])
+else:
+    raise ValueError("Unknown action %s" % action)
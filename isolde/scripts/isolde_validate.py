@@ -0,0 +1,156 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+ChimeraX script used by the ISOLDE protocol to compute per-residue fit
+metrics of several refined models in a single session:
+
+    ChimeraX --nogui --offscreen --exit --script \
+        "isolde_validate.py jobs.json table.csv summary.json"
+
+jobs.json is a list of {"name", "model", "map"}. Every map is opened once.
+For each residue the table has the mean density at its heavy atoms, in
+rms above the map mean, the number of its atoms in clashes and whether
+it is a Ramachandran or rotamer outlier. Empty values mean the metric
+does not apply or could not be computed. summary.json has the totals
+per model.
+"""
+
+import csv
+import json
+import sys
+
+import numpy as np
+
+from chimerax.atomic import Atoms
+from chimerax.clashes.clashes import find_clashes
+from chimerax.core.commands import run
+from chimerax.isolde import session_extensions as sx
+
+# MolProbity counts overlaps of at least 0.4 A
+CLASH_OVERLAP = 0.4
+
+jobsFile, tableFile, summaryFile = sys.argv[1:4]
+with open(jobsFile) as f:
+    jobs = json.load(f)
+
+
+def outlierFlags(residues, getManager, getItems):
+    """ 1 for outliers, 0 for validated residues and -1 for residues the
+    validator does not apply to. None if the validation failed.
+    """
+    try:
+        manager = getManager(session)
+        items = getItems(manager, residues)
+        outliers = manager.outliers(items)
+    except Exception as e:
+        session.logger.warning("Validation not available: %s" % e)
+        return None
+    if isinstance(outliers, tuple):
+        outliers = outliers[0]
+    flags = np.full(len(residues), -1, dtype=np.int8)
+    flags[residues.indices(items.residues)] = 0
+    flags[residues.indices(outliers.residues)] = 1
+    return flags
+
+
+def densityScores(volume, residues, atoms):
+    """ Mean density of the atoms of every residue, in rms over the mean
+    of the map.
+    """
+    mean, sd, rms = volume.mean_sd_rms()
+    values = (volume.interpolated_values(atoms.scene_coords) - mean) / sd
+    index = residues.indices(atoms.residues)
+    counts = np.bincount(index, minlength=len(residues))
+    sums = np.bincount(index, weights=values, minlength=len(residues))
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def clashCounts(residues, atoms):
+    """ Number of atoms in clash per residue, and clashscore. """
+    clashes = find_clashes(session, atoms, clash_threshold=CLASH_OVERLAP,
+                           inter_model=False)
+    counts = np.zeros(len(residues), dtype=int)
+    if clashes:
+        index = residues.indices(Atoms(list(clashes.keys())).residues)
+        counts = np.bincount(index, minlength=len(residues))
+    pairs = sum(len(others) for others in clashes.values()) / 2
+    return counts, 1000.0 * pairs / max(len(atoms), 1)
+
+
+def validRamas(manager, residues):
+    ramas = manager.get_ramas(residues)
+    return ramas[ramas.valids]
+
+
+def allRotamers(manager, residues):
+    return manager.get_rotamers(residues)
+
+
+def percent(flags):
+    valid = flags >= 0
+    return 100.0 * (flags == 1).sum() / max(valid.sum(), 1)
+
+
+# ChimeraX provides the session global when running the script
+volumes = {}
+summary = {}
+with open(tableFile, 'w', newline='') as table:
+    writer = csv.writer(table)
+    writer.writerow(['model', 'chain', 'residue', 'name', 'density',
+                     'clashes', 'rama_outlier', 'rotamer_outlier'])
+    for job in jobs:
+        if job['map'] not in volumes:
+            volumes[job['map']] = run(session, 'open %s' % job['map'])[0]
+        volume = volumes[job['map']]
+        model = run(session, 'open %s' % job['model'])[0]
+        residues = model.residues
+        heavy = model.atoms[model.atoms.element_names != 'H']
+
+        density = densityScores(volume, residues, heavy)
+        clashes, clashscore = clashCounts(residues, model.atoms)
+        rama = outlierFlags(residues, sx.get_ramachandran_mgr, validRamas)
+        rotamers = outlierFlags(residues, sx.get_rotamer_mgr, allRotamers)
+
+        for i, residue in enumerate(residues):
+            writer.writerow([
+                job['name'], residue.chain_id, residue.number, residue.name,
+                '' if np.isnan(density[i]) else '%.3f' % density[i],
+                clashes[i],
+                '' if rama is None or rama[i] < 0 else rama[i],
+                '' if rotamers is None or rotamers[i] < 0 else rotamers[i]])
+        summary[job['name']] = {
+            'residues': len(residues),
+            'atoms': len(model.atoms),
+            'density': float(np.nanmean(density)),
+            'clashscore': clashscore,
+            'ramaOutliers': None if rama is None else percent(rama),
+            'rotamerOutliers': None if rotamers is None
+            else percent(rotamers)}
+        run(session, 'close #%s' % model.id_string)
+
+with open(summaryFile, 'w') as f:
+    json.dump(summary, f, indent=1)
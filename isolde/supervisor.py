@@ -0,0 +1,201 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Supervised ChimeraX processes. ChimeraX is started as a child whose PID
+is known and whose output is forwarded to the run log while it runs,
+optionally bounded in wall time and memory, and its real exit status is
+checked instead of leaving it in the background of a shell. Sessions
+that must outlive the caller, like those of the viewer, are detached.
+"""
+
+import collections
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+
+# Seconds between two checks of a running process
+POLL_INTERVAL = 1.0
+# Seconds a process is given to exit before it is killed
+STOP_TIMEOUT = 10
+# Last lines of output quoted when a process fails
+TAIL_LINES = 20
+
+
+def writeStdout(line):
+    """ Default log, the standard output is the run log of a protocol. """
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+class SupervisedProcess:
+    """ Child process whose output is forwarded line by line to log,
+    prefixed by label if given. Its PID is written in pidFile, if given,
+    while it runs.
+    """
+    def __init__(self, args, cwd=None, env=None, log=None, label=None,
+                 pidFile=None):
+        self.args = args
+        self.log = log or writeStdout
+        self.label = label
+        self.pidFile = pidFile
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self.log("** Running command: **\n%s" % " ".join(args))
+        self.process = subprocess.Popen(args, cwd=cwd, env=env,
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True,
+                                        errors='replace')
+        if pidFile:
+            with open(pidFile, 'w') as f:
+                f.write("%d\n" % self.process.pid)
+        self._reader = threading.Thread(target=self._forward, daemon=True)
+        self._reader.start()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def _forward(self):
+        prefix = "[%s] " % self.label if self.label else ""
+        for line in self.process.stdout:
+            line = line.rstrip("\n")
+            self.tail.append(line)
+            self.log(prefix + line)
+
+    def getMemory(self):
+        """ Resident memory, in GB, of the process and its children. """
+        try:
+            process = psutil.Process(self.process.pid)
+            rss = sum(p.memory_info().rss
+                      for p in [process] + process.children(recursive=True))
+        except psutil.Error:
+            return 0
+        return rss / 1024 ** 3
+
+    def stop(self):
+        """ Terminate the process and its children, killing those that do
+        not exit.
+        """
+        try:
+            processes = psutil.Process(self.process.pid).children(
+                recursive=True)
+        except psutil.Error:
+            processes = []
+        self.process.terminate()
+        for process in processes:
+            try:
+                process.terminate()
+            except psutil.Error:
+                pass
+        try:
+            self.process.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        _, alive = psutil.wait_procs(processes, timeout=STOP_TIMEOUT)
+        for process in alive:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+
+    def wait(self, wallTime=0, maxMemory=0, onPoll=None,
+             interval=POLL_INTERVAL):
+        """ Wait for the process to exit, calling onPoll every interval
+        seconds and once more at the end. The process is stopped when it
+        runs longer than wallTime (s) or uses more than maxMemory (GB), 0
+        for no limit. An exception is raised unless it exits with status 0.
+        """
+        start = time.time()
+        try:
+            finished = False
+            while not finished:
+                try:
+                    self.process.wait(timeout=interval)
+                    finished = True
+                except subprocess.TimeoutExpired:
+                    pass
+                if onPoll:
+                    onPoll()
+                if finished:
+                    break
+                if wallTime and time.time() - start > wallTime:
+                    self.stop()
+                    raise Exception("%s (PID %d) stopped after exceeding "
+                                    "the wall time limit of %g s"
+                                    % (self.args[0], self.pid, wallTime))
+                if maxMemory and self.getMemory() > maxMemory:
+                    self.stop()
+                    raise Exception("%s (PID %d) stopped after exceeding "
+                                    "the memory limit of %g GB"
+                                    % (self.args[0], self.pid, maxMemory))
+        finally:
+            if self.process.poll() is None:
+                self.stop()
+            self._reader.join()
+            if self.pidFile and os.path.exists(self.pidFile):
+                os.remove(self.pidFile)
+        if self.process.returncode != 0:
+            raise Exception("%s (PID %d) failed with exit status %d:\n%s"
+                            % (self.args[0], self.pid,
+                               self.process.returncode,
+                               "\n".join(self.tail)))
+
+
+def runSupervised(args, cwd=None, env=None, label=None, pidFile=None,
+                  log=None, **limits):
+    """ Run a process and wait for it, see SupervisedProcess.wait for the
+    limits.
+    """
+    SupervisedProcess(args, cwd, env, log=log, label=label,
+                      pidFile=pidFile).wait(**limits)
+
+
+def runInBackground(args, cwd=None, env=None, logFile=None):
+    """ Start a process detached in its own session, for callers like the
+    viewer that must return at once and may exit before it. Its output is
+    appended to logFile, or discarded, rather than piped to a reader that
+    would not outlive the caller. It is reaped from a daemon thread while
+    the caller runs.
+    """
+    output = open(logFile, 'a') if logFile else subprocess.DEVNULL
+    try:
+        process = subprocess.Popen(args, cwd=cwd, env=env,
+                                   stdin=subprocess.DEVNULL, stdout=output,
+                                   stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+    finally:
+        if logFile:
+            output.close()
+    threading.Thread(target=process.wait, daemon=True).start()
+    return process
@@ -0,0 +1,67 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Access to the coordinate checkpoints written during ISOLDE simulations.
+A trajectory directory holds the topology as mmCIF, the frames as raw
+float32 coordinates and a small JSON file describing them.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from .constants import TRAJECTORY_COORDS, TRAJECTORY_INFO, TRAJECTORY_TOPOLOGY
+
+
+def getTrajectoryInfo(directory):
+    """ Description of the trajectory in directory, or None if there is
+    none or it has no frames.
+    """
+    infoFile = os.path.join(directory, TRAJECTORY_INFO)
+    if not os.path.exists(infoFile):
+        return None
+    with open(infoFile) as f:
+        info = json.load(f)
+    return info if info['frames'] > 0 else None
+
+
+def readTrajectory(directory):
+    """ Memory-mapped array of shape (frames, atoms, 3) with the saved
+    coordinates. Frames are read from disk only when accessed.
+    """
+    info = getTrajectoryInfo(directory)
+    if info is None:
+        return None
+    return np.memmap(os.path.join(directory, TRAJECTORY_COORDS),
+                     dtype=np.float32, mode='r',
+                     shape=(info['frames'], info['atoms'], 3))
+
+
+def getTopologyFile(directory):
+    return os.path.join(directory, TRAJECTORY_TOPOLOGY)
@@ -0,0 +1,177 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Helpers shared by the ISOLDE protocol to run several headless ChimeraX
+sessions at the same time.
+"""
+
+import functools
+import os
+import queue
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from .constants import CHIMERA_PID
+from .supervisor import runSupervised
+
+
+def getNumberOfWorkers(requested, memPerWorker):
+    """ Number of ChimeraX workers that can run at once: the requested
+    value bounded by the available cores and by the free memory
+    (memPerWorker in GB). At least one worker is always allowed.
+    """
+    workers = min(requested, os.cpu_count() or 1)
+    if memPerWorker > 0:
+        freeGb = psutil.virtual_memory().available / 1024 ** 3
+        workers = min(workers, int(freeGb // memPerWorker))
+    return max(1, workers)
+
+
+# Thread pools of ChimeraX, OpenMM and the numerical libraries
+THREAD_VARIABLES = ['OPENMM_CPU_THREADS', 'OMP_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def getLaunchSettings(numberOfThreads, numberOfWorkers=1, platform=None,
+                      pinCpus=False, wallTime=0, maxMemory=0):
+    """ Resources of each of numberOfWorkers concurrent ChimeraX processes
+    sharing numberOfThreads: threads per process, OpenMM platform name
+    (None lets ISOLDE choose) and, when pinning, the cores of every worker
+    slot. Workers are capped at numberOfThreads so that every process
+    gets a thread of its own. Pinning needs taskset and is skipped
+    without it. Processes are stopped after wallTime seconds or maxMemory
+    GB, 0 for no limit.
+    """
+    numberOfWorkers = max(1, min(numberOfWorkers, numberOfThreads))
+    threads = max(1, numberOfThreads // numberOfWorkers)
+    cpus = None
+    if pinCpus and hasattr(os, 'sched_getaffinity') \
+            and shutil.which('taskset'):
+        cores = sorted(os.sched_getaffinity(0))
+        cpus = [sorted({cores[(slot * threads + i) % len(cores)]
+                        for i in range(threads)})
+                for slot in range(numberOfWorkers)]
+    return {'workers': numberOfWorkers, 'threads': threads,
+            'platform': platform, 'cpus': cpus,
+            'wallTime': wallTime, 'maxMemory': maxMemory}
+
+
+def getLaunchEnviron(settings):
+    """ Environment variables that bound the threads and select the OpenMM
+    platform of one ChimeraX process.
+    """
+    environ = {name: str(settings['threads']) for name in THREAD_VARIABLES}
+    if settings['platform']:
+        environ['OPENMM_DEFAULT_PLATFORM'] = settings['platform']
+    return environ
+
+
+def getScript(scriptName):
+    """ Path of one of the ChimeraX scripts shipped with the plugin. """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'scripts', scriptName)
+
+
+@functools.lru_cache(maxsize=None)
+def getChimeraXProgram():
+    """ Path of the ChimeraX binary, resolved once per process. """
+    from chimera import Plugin as chimera
+    return chimera.getProgram()
+
+
+def runHeadlessChimera(scriptFile, cwd, args=None, settings=None, slot=0,
+                       label=None, offscreen=True, log=None):
+    """ Run a ChimeraX Python script without graphics and wait for it.
+    Arguments for the script, if any, are passed in sys.argv. The
+    process gets the threads, platform, limits and, if pinned, the cores
+    of the given slot of the launch settings. Its PID is kept in cwd
+    while it runs and its output, prefixed by label, goes to log, the
+    standard output by default. Scripts that do not render can skip the
+    offscreen OpenGL context.
+    """
+    from chimera import Plugin as chimera
+    scriptFile = os.path.abspath(scriptFile)
+    command = [getChimeraXProgram(), '--nogui', '--exit']
+    if offscreen:
+        command.insert(2, '--offscreen')
+    if args:
+        command += ['--script',
+                    " ".join([scriptFile] + [str(arg) for arg in args])]
+    else:
+        command.append(scriptFile)
+    environ = chimera.getEnviron()
+    limits = {}
+    if settings:
+        environ.update(getLaunchEnviron(settings))
+        limits = {'wallTime': settings['wallTime'],
+                  'maxMemory': settings['maxMemory']}
+        cpus = settings['cpus']
+        if cpus:
+            command = ['taskset', '-c',
+                       ",".join(map(str, cpus[slot % len(cpus)]))] + command
+    cwd = os.path.abspath(cwd)
+    runSupervised(command, cwd, environ, label=label,
+                  pidFile=os.path.join(cwd, CHIMERA_PID % slot), log=log,
+                  **limits)
+
+
+def runHeadlessChimeraJobs(jobs, numberOfWorkers, settings=None, log=None):
+    """ Run a list of (scriptFile, cwd[, args]) headless ChimeraX jobs with
+    at most numberOfWorkers of them running at the same time. All jobs are run
+    even if some fail; an exception listing the failed scripts is raised
+    at the end. Each running job holds one worker slot of the settings,
+    whose workers bound numberOfWorkers.
+    """
+    if settings:
+        numberOfWorkers = min(numberOfWorkers, settings['workers'])
+    slots = queue.Queue()
+    for slot in range(numberOfWorkers):
+        slots.put(slot)
+
+    def runJob(scriptFile, cwd, args=None):
+        slot = slots.get()
+        try:
+            runHeadlessChimera(scriptFile, cwd, args, settings, slot,
+                               label=os.path.basename(cwd), log=log)
+        finally:
+            slots.put(slot)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+        futures = [(job[0], executor.submit(runJob, *job))
+                   for job in jobs]
+        for scriptFile, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed.append("%s: %s" % (scriptFile, e))
+    if failed:
+        raise Exception("%d of %d ChimeraX jobs failed:\n%s"
+                        % (len(failed), len(jobs), "\n".join(failed)))
@@ -24,83 +24,170 @@
 # *
 # **************************************************************************
 
+import fnmatch
 import os
 
+from ..constants import VIEW_NEWEST, VIEW_ALL, VIEW_CHOSEN, VIEWER_LOG
 from ..protocols.protocol_isolde import ProtIsolde
+from ..manifest import OutputManifest, ATOMSTRUCT, VOLUME
+from ..supervisor import runInBackground
+from ..utils import getChimeraXProgram
+from ..volumes import getMapInfo, suggestLevel
 
-from pwem.convert import Ccp4Header
-from pwem.emlib.image import ImageHandler
-from pwem.objects import Volume
-from pwem.objects import Transform
+from pyworkflow.protocol.params import (LabelParam, EnumParam, IntParam,
+                                        StringParam)
+from pyworkflow.viewer import DESKTOP_TKINTER, ProtocolViewer
 
-from pwem.viewers.viewer_chimera import (Chimera,
-                                         sessionFile)
-from pyworkflow.viewer import DESKTOP_TKINTER, Viewer
 
-from chimera import Plugin as chimera
-
-
-class IsoldeViewer(Viewer):
+class IsoldeViewer(ProtocolViewer):
     """ Visualize the output of protocols protocol_fit and protocol_operate """
+    _label = 'ISOLDE viewer'
     _environments = [DESKTOP_TKINTER]
     _targets = [ProtIsolde]
 
-    def _visualize(self, obj, **args):
-        """ Visualize any saved pdb and map if none were saved
+    def _defineParams(self, form):
+        form.addSection(label='Visualization')
+        form.addParam('displayOutputs', LabelParam,
+                      label='Open saved outputs in ChimeraX',
+                      help="Open the selected maps and models saved by the "
+                           "protocol. If none were saved the input files "
+                           "are shown.")
+        form.addParam('selection', EnumParam, default=VIEW_ALL,
+                      choices=['newest', 'all', 'chosen'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Outputs to open',
+                      help="Open only the newest snapshots, all the saved "
+                           "files, or the files chosen by name.")
+        form.addParam('numberOfSnapshots', IntParam, default=1,
+                      condition='selection == %d' % VIEW_NEWEST,
+                      label='Number of snapshots',
+                      help="Number of the most recently saved models, and "
+                           "of maps, to open. Files are ranked by their "
+                           "modification time, not by their names.")
+        form.addParam('chosenFiles', StringParam, default='',
+                      condition='selection == %d' % VIEW_CHOSEN,
+                      label='Files',
+                      help="Names of the saved files to open, separated by "
+                           "spaces. Wildcards are allowed, e.g. "
+                           "Atom_struct__*_00001*.cif")
+        form.addParam('mapStep', IntParam, default=1,
+                      label='Map step',
+                      help="Show every Nth voxel of the maps along each "
+                           "axis. Larger steps open big maps faster and "
+                           "with less memory.")
+        form.addParam('mapRegion', StringParam, default='',
+                      label='Map region',
+                      help="Grid index range to show, as "
+                           "i1,j1,k1,i2,j2,k2. Leave empty to show the "
+                           "whole map.")
+
+    def _getVisualizeDict(self):
+        return {'displayOutputs': self._visualizeOutputs}
+
+    def _select(self, fileNames, mtimes):
+        """ Files to open among the saved ones, given in the order they
+        were saved with their modification times.
+        """
+        selection = self.selection.get()
+        if selection == VIEW_CHOSEN:
+            patterns = self.chosenFiles.get().split()
+            return [fileName for fileName in fileNames
+                    if any(fnmatch.fnmatch(os.path.basename(fileName),
+                                           pattern) for pattern in patterns)]
+        if selection == VIEW_NEWEST:
+            n = self.numberOfSnapshots.get()
+            if n <= 0:
+                return []
+            ranked = sorted(range(len(fileNames)), key=lambda i: mtimes[i])
+            return [fileNames[i] for i in sorted(ranked[-n:])]
+        return fileNames
+
+    def _writeMapOptions(self, f, counter):
+        """ Subsampling and region of an opened map. """
+        if self.mapStep.get() > 1:
+            f.write("volume #%d step %d\n" % (counter, self.mapStep.get()))
+        if self.mapRegion.get().strip():
+            f.write("volume #%d region %s\n"
+                    % (counter, self.mapRegion.get().strip()))
+
+    def _visualizeOutputs(self, e=None):
+        """ Visualize the selected saved pdbs and maps, if none were saved
         show the input files.
         """
-        _inputVolFlag = False
-        _inputPDBFlag = False
-        directory = self.protocol._getExtraPath()
+        # Imported here so that loading the viewers does not load it
+        from chimera import Plugin as chimera
+
+        # Read only, the protocol may be adding to the manifest
+        manifest = OutputManifest(self.protocol._getExtraPath())
+        entries = manifest.peek()
+        volEntries = [entry for entry in entries if entry['type'] == VOLUME]
+        pdbEntries = [entry for entry in entries
+                      if entry['type'] == ATOMSTRUCT]
+        volNames = self._select([entry['filename'] for entry in volEntries],
+                                [manifest.getMtime(entry)
+                                 for entry in volEntries])
+        pdbNames = self._select([entry['filename'] for entry in pdbEntries],
+                                [manifest.getMtime(entry)
+                                 for entry in pdbEntries])
 
         fnCmd = os.path.abspath(self.protocol._getTmpPath("chimera_output.cxc"))
         f = open(fnCmd, 'w')
         f.write('cd %s\n' % os.getcwd())
 
         counter = 0
-        # Find all saved maps and pdbs from protocl. If none
-        # are found show the input files to the protocol
-        for filename in sorted(os.listdir(directory)):
-            if filename.endswith(".mrc"):
-                _inputVolFlag = True
+        # Find the selected maps and pdbs from protocol. If none
+        # were saved show the input files to the protocol
+        for entry in volEntries:
+            if entry['filename'] in volNames:
                 counter += 1
-                volFileName = os.path.join(directory, filename)
-                vol = Volume()
-                vol.setFileName(volFileName)
-
-                # fix mrc header
-                ccp4header = Ccp4Header(volFileName, readHeader=True)
-                sampling = ccp4header.computeSampling()
-                origin = Transform()
-                shifts = ccp4header.getOrigin()
-                origin.setShiftsTuple(shifts)
+                volFileName = manifest.getPath(entry)
+                sampling = entry['sampling']
+                shifts = entry['origin']
                 f.write("open %s\n" % volFileName)
-                f.write("volume #%d style surface voxelSize %f\n"
+                level = suggestLevel(getMapInfo(volFileName, statistics=True))
+                f.write("volume #%d style surface level %f voxelSize %f\n"
                         "volume #%d origin %0.2f,%0.2f,%0.2f\n"
-                        % (counter, sampling, counter, shifts[0], shifts[1], shifts[2]))
+                        % (counter, level, sampling, counter, shifts[0], shifts[1], shifts[2]))
+                self._writeMapOptions(f, counter)
                 # Set volume to translucent
                 f.write("volume #%d transparency 0.5\n" % counter)
 
-        for filename in os.listdir(directory):
-            if filename.endswith(".pdb") or filename.endswith(".cif"):
-                _inputPDBFlag = True
-                path = os.path.join(directory, filename)
-                f.write("open %s\n" % path)
+        for entry in pdbEntries:
+            if entry['filename'] in pdbNames:
+                f.write("open %s\n" % manifest.getPath(entry))
 
+        _inputVolFlag = bool(volEntries)
+        _inputPDBFlag = bool(pdbEntries)
 
         # If no pdbs or maps found use inputs to protocol
         if not _inputVolFlag:
             counter += 1
-            f.write("open %s \n" % os.path.abspath(self.protocol.inputVolume.get().getFileName()))
+            volFileName = os.path.abspath(self.protocol.inputVolume.get().getFileName())
+            f.write("open %s \n" % volFileName)
+            if volFileName.endswith((".mrc", ".map")):
+                f.write("volume #%d level %f\n"
+                        % (counter, suggestLevel(getMapInfo(volFileName, statistics=True))))
+            self._writeMapOptions(f, counter)
             # Set volume to translucent
             f.write("volume #%d transparency 0.5\n" % counter)
 
-        if not _inputPDBFlag:
+        # Batch and sweep models are registered as a set, not in the manifest
+        if hasattr(self.protocol, 'outputAtomStructs'):
+            _inputPDBFlag = True
+            structs = [os.path.abspath(struct.getFileName())
+                       for struct in self.protocol.outputAtomStructs]
+            mtimes = [os.path.getmtime(fileName) for fileName in structs]
+            for fileName in self._select(structs, mtimes):
+                f.write("open %s\n" % fileName)
+
+        if not _inputPDBFlag and not self.protocol.useSet:
             f.write("open %s \n" % os.path.abspath(self.protocol.pdbFileToBeRefined.get().getFileName()))
 
 
         f.close()
 
-        # run in the background
-        Chimera.runProgram(chimera.getProgram(), fnCmd + "&")
-        return []
\ No newline at end of file
+        # Returns at once, the session is reaped when it is closed
+        runInBackground([getChimeraXProgram(), fnCmd],
+                        env=chimera.getEnviron(),
+                        logFile=self.protocol._getTmpPath(VIEWER_LOG))
+        return []
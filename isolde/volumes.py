@@ -0,0 +1,109 @@
+# **************************************************************************
+# *
+# * Authors: Jorge Garcia Condado (jgcondado@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Metadata of MRC maps for the protocol and the viewer. Only the header is
+read, and the density is memory mapped when statistics are requested, so
+the cost does not grow with the size of the map. Results are kept per
+file path and modification time, so a map is read once per process.
+"""
+
+import functools
+import os
+
+import numpy as np
+
+HEADER_SIZE = 1024
+# Maximum number of voxels read to estimate the statistics of a map
+MAX_STAT_VOXELS = 4 * 1024 ** 2
+
+MODES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16,
+         12: np.float16}
+
+
+def getMapInfo(fileName, statistics=False):
+    """ Dict with the size in voxels, sampling and origin (Angstroms) of
+    an MRC map, computed as Ccp4Header does. With statistics, it also
+    has the min, max, mean and rms of the density.
+    """
+    stat = os.stat(fileName)
+    info = _readMapInfo(os.path.abspath(fileName), stat.st_mtime_ns,
+                        stat.st_size, statistics)
+    return dict(info)
+
+
+def suggestLevel(info, sigmas=3.0):
+    """ Surface threshold a number of rms above the mean of the map,
+    kept below the maximum so that the surface is never empty.
+    """
+    level = info['mean'] + sigmas * info['rms']
+    if level >= info['max']:
+        level = (info['mean'] + info['max']) / 2
+    return level
+
+
+@functools.lru_cache(maxsize=256)
+def _readMapInfo(path, mtime, size, statistics):
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    # Byte order from the machine stamp, 0x11 for big endian
+    order = '>' if header[212] == 0x11 else '<'
+    words = np.frombuffer(header, dtype=order + 'i4', count=56)
+    floats = np.frombuffer(header, dtype=order + 'f4', count=56)
+    dims = [int(n) for n in words[0:3]]
+    start = [int(n) for n in words[4:7]]
+    grid = words[9]
+    sampling = float(floats[12] / grid) if grid else 1.0
+    origin = [float(x) for x in floats[49:52]]
+    if all(x == 0 for x in origin) or np.isnan(origin).any():
+        origin = [n * sampling for n in start]
+    info = {'size': dims, 'mode': int(words[3]), 'sampling': sampling,
+            'origin': origin}
+    if statistics:
+        info.update(_readStatistics(path, order, words, floats, dims))
+    return info
+
+
+def _readStatistics(path, order, words, floats, dims):
+    """ min, max, mean and rms of the map. The values in the header are
+    used when they are set, otherwise they are estimated from a regular
+    subsample of the memory mapped density.
+    """
+    minimum, maximum, mean = (float(x) for x in floats[19:22])
+    rms = float(floats[54])
+    if maximum > minimum and rms > 0:
+        return {'min': minimum, 'max': maximum, 'mean': mean, 'rms': rms}
+
+    dtype = np.dtype(MODES[int(words[3])]).newbyteorder(order)
+    nc, nr, ns = dims
+    data = np.memmap(path, dtype=dtype, mode='r',
+                     offset=HEADER_SIZE + int(words[23]),
+                     shape=(ns, nr, nc))
+    step = max(1, int(np.ceil((data.size / MAX_STAT_VOXELS) ** (1 / 3.))))
+    sample = np.asarray(data[::step, ::step, ::step], dtype=np.float64)
+    return {'min': float(sample.min()), 'max': float(sample.max()),
+            'mean': float(sample.mean()), 'rms': float(sample.std())}
@@ -38,6 +38,6 @@ setup(
         'pyworkflow.plugin': 'isolde = isolde'
     },
     package_data={  # Optional
-       'isolde': ['icon.png'],
+       'isolde': ['icon.jpg', 'scripts/*.py'],
     }
 )
\ No newline at end of file